@@ -3,17 +3,27 @@
 import argparse
 import numpy as np
 import sys
+import time
 import cv2
 
 import tritonclient.grpc as grpcclient
 from tritonclient.utils import InferenceServerException
 
-from processing import preprocess, postprocess
+from processing import input_spec, preprocess, postprocess
 from render import render_box, render_filled_box, get_text_size, render_text, RAND_COLORS
 from labels import COCOLabels
+from pipeline import InferencePipeline, INPUT_NAMES, OUTPUT_NAMES
+
+
+def render_detections(frame, detected_objects):
+    for box in detected_objects:
+        print(f"{COCOLabels(box.classID).name}: {box.confidence}")
+        frame = render_box(frame, box.box(), color=tuple(RAND_COLORS[box.classID % 64].tolist()))
+        size = get_text_size(frame, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", normalised_scaling=0.6)
+        frame = render_filled_box(frame, (box.x1 - 3, box.y1 - 3, box.x1 + size[0], box.y1 + size[1]), color=(220, 220, 220))
+        frame = render_text(frame, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", (box.x1, box.y1), color=(30, 30, 30), normalised_scaling=0.5)
+    return frame
 
-INPUT_NAMES = ["images"]
-OUTPUT_NAMES = ["num_dets", "det_boxes", "det_scores", "det_classes"]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -59,6 +69,37 @@ if __name__ == '__main__':
                         required=False,
                         default=24.0,
                         help='Video output fps, default 24.0 FPS')
+    parser.add_argument('--in-flight',
+                        type=int,
+                        required=False,
+                        default=0,
+                        help='Video mode: number of asynchronous requests kept in flight, default 0 (synchronous)')
+    parser.add_argument('-b',
+                        '--batch',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='Video mode with --in-flight: frames batched per request, default 1')
+    parser.add_argument('--shared-memory',
+                        action="store_true",
+                        required=False,
+                        default=False,
+                        help='Video mode: pass tensors through system shared memory, server must run on the same host')
+    parser.add_argument('--uint8-input',
+                        action="store_true",
+                        required=False,
+                        default=False,
+                        help='Send raw uint8 images, for models exported with --uint8-input')
+    parser.add_argument('--nhwc',
+                        action="store_true",
+                        required=False,
+                        default=False,
+                        help='Send NHWC images, for models exported with --uint8-input --nhwc')
+    parser.add_argument('--bgr',
+                        action="store_true",
+                        required=False,
+                        default=False,
+                        help='Send BGR images, for models exported with --uint8-input --bgr')
     parser.add_argument('-i',
                         '--model-info',
                         action="store_true",
@@ -103,6 +144,8 @@ if __name__ == '__main__':
                         help='File holding PEM-encoded certicate chain default is none')
 
     FLAGS = parser.parse_args()
+    if (FLAGS.nhwc or FLAGS.bgr) and not FLAGS.uint8_input:
+        parser.error('--nhwc and --bgr require --uint8-input')  # as export.py, FP32 input is NCHW RGB
 
     # Create server context
     try:
@@ -156,14 +199,17 @@ if __name__ == '__main__':
             print("Got: {}".format(ex.message()))
             sys.exit(1)
 
+    input_format = dict(uint8=FLAGS.uint8_input, nhwc=FLAGS.nhwc, bgr=FLAGS.bgr)
+    input_shape, dtype, datatype = input_spec([FLAGS.width, FLAGS.height], FLAGS.uint8_input, FLAGS.nhwc)
+
     # DUMMY MODE
     if FLAGS.mode == 'dummy':
         print("Running in 'dummy' mode")
         print("Creating emtpy buffer filled with ones...")
         inputs = []
         outputs = []
-        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, 3, FLAGS.width, FLAGS.height], "FP32"))
-        inputs[0].set_data_from_numpy(np.ones(shape=(1, 3, FLAGS.width, FLAGS.height), dtype=np.float32))
+        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, *input_shape], datatype))
+        inputs[0].set_data_from_numpy(np.ones(shape=(1, *input_shape), dtype=dtype))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[0]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[1]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[2]))
@@ -196,7 +242,7 @@ if __name__ == '__main__':
 
         inputs = []
         outputs = []
-        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, 3, FLAGS.width, FLAGS.height], "FP32"))
+        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, *input_shape], datatype))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[0]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[1]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[2]))
@@ -207,7 +253,7 @@ if __name__ == '__main__':
         if input_image is None:
             print(f"FAILED: could not load input image {str(FLAGS.input)}")
             sys.exit(1)
-        input_image_buffer = preprocess(input_image, [FLAGS.width, FLAGS.height])
+        input_image_buffer = preprocess(input_image, [FLAGS.width, FLAGS.height], **input_format)
         input_image_buffer = np.expand_dims(input_image_buffer, axis=0)
 
         inputs[0].set_data_from_numpy(input_image_buffer)
@@ -237,12 +283,7 @@ if __name__ == '__main__':
         detected_objects = postprocess(num_dets, det_boxes, det_scores, det_classes, input_image.shape[1], input_image.shape[0], [FLAGS.width, FLAGS.height])
         print(f"Detected objects: {len(detected_objects)}")
 
-        for box in detected_objects:
-            print(f"{COCOLabels(box.classID).name}: {box.confidence}")
-            input_image = render_box(input_image, box.box(), color=tuple(RAND_COLORS[box.classID % 64].tolist()))
-            size = get_text_size(input_image, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", normalised_scaling=0.6)
-            input_image = render_filled_box(input_image, (box.x1 - 3, box.y1 - 3, box.x1 + size[0], box.y1 + size[1]), color=(220, 220, 220))
-            input_image = render_text(input_image, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", (box.x1, box.y1), color=(30, 30, 30), normalised_scaling=0.5)
+        input_image = render_detections(input_image, detected_objects)
 
         if FLAGS.out:
             cv2.imwrite(FLAGS.out, input_image)
@@ -261,7 +302,7 @@ if __name__ == '__main__':
 
         inputs = []
         outputs = []
-        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, 3, FLAGS.width, FLAGS.height], "FP32"))
+        inputs.append(grpcclient.InferInput(INPUT_NAMES[0], [1, *input_shape], datatype))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[0]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[1]))
         outputs.append(grpcclient.InferRequestedOutput(OUTPUT_NAMES[2]))
@@ -273,21 +314,51 @@ if __name__ == '__main__':
             print(f"FAILED: cannot open video {FLAGS.input}")
             sys.exit(1)
 
+        def emit(frame, detected_objects):
+            # Render and write or display one frame, returns False if the user quit
+            global counter
+            print(f"Frame {counter}: {len(detected_objects)} objects")
+            counter += 1
+            frame = render_detections(frame, detected_objects)
+            if FLAGS.out:
+                out.write(frame)
+            else:
+                cv2.imshow('image', frame)
+                if cv2.waitKey(1) == ord('q'):
+                    return False
+            return True
+
+        pipeline = None
+        if FLAGS.in_flight > 0 or FLAGS.shared_memory:
+            in_flight = max(FLAGS.in_flight, 1)
+            print(f"Pipelining {in_flight} requests of {FLAGS.batch} frames")
+            pipeline = InferencePipeline(triton_client, FLAGS.model, [FLAGS.width, FLAGS.height],
+                                         in_flight=in_flight, batch=FLAGS.batch,
+                                         client_timeout=FLAGS.client_timeout, shared_memory=FLAGS.shared_memory,
+                                         **input_format)
+
         counter = 0
         out = None
+        running = True
         print("Invoking inference...")
-        while True:
+        t0 = time.time()
+        while running:
             ret, frame = cap.read()
             if not ret:
                 print("failed to fetch next frame")
                 break
 
-            if counter == 0 and FLAGS.out:
+            if out is None and FLAGS.out:
                 print("Opening output video stream...")
                 fourcc = cv2.VideoWriter_fourcc('M', 'P', '4', 'V')
                 out = cv2.VideoWriter(FLAGS.out, fourcc, FLAGS.fps, (frame.shape[1], frame.shape[0]))
 
-            input_image_buffer = preprocess(frame, [FLAGS.width, FLAGS.height])
+            if pipeline:
+                for result in pipeline.put(frame):
+                    running = running and emit(*result)
+                continue
+
+            input_image_buffer = preprocess(frame, [FLAGS.width, FLAGS.height], **input_format)
             input_image_buffer = np.expand_dims(input_image_buffer, axis=0)
 
             inputs[0].set_data_from_numpy(input_image_buffer)
@@ -302,22 +373,15 @@ if __name__ == '__main__':
             det_scores = results.as_numpy("det_scores")
             det_classes = results.as_numpy("det_classes")
             detected_objects = postprocess(num_dets, det_boxes, det_scores, det_classes, frame.shape[1], frame.shape[0], [FLAGS.width, FLAGS.height])
-            print(f"Frame {counter}: {len(detected_objects)} objects")
-            counter += 1
-
-            for box in detected_objects:
-                print(f"{COCOLabels(box.classID).name}: {box.confidence}")
-                frame = render_box(frame, box.box(), color=tuple(RAND_COLORS[box.classID % 64].tolist()))
-                size = get_text_size(frame, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", normalised_scaling=0.6)
-                frame = render_filled_box(frame, (box.x1 - 3, box.y1 - 3, box.x1 + size[0], box.y1 + size[1]), color=(220, 220, 220))
-                frame = render_text(frame, f"{COCOLabels(box.classID).name}: {box.confidence:.2f}", (box.x1, box.y1), color=(30, 30, 30), normalised_scaling=0.5)
-
-            if FLAGS.out:
-                out.write(frame)
-            else:
-                cv2.imshow('image', frame)
-                if cv2.waitKey(1) == ord('q'):
-                    break
+            running = emit(frame, detected_objects)
+
+        if pipeline:
+            for result in pipeline.drain():
+                if running:
+                    running = emit(*result)
+            pipeline.close()
+        dt = time.time() - t0
+        print(f"Processed {counter} frames in {dt:.2f}s ({counter / dt:.1f} FPS)")
 
         if FLAGS.model_info:
             statistics = triton_client.get_inference_statistics(model_name=FLAGS.model)
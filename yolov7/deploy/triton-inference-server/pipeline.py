@@ -0,0 +1,193 @@
+import os
+from functools import partial
+from queue import Queue
+from threading import Condition
+
+import numpy as np
+
+import tritonclient.grpc as grpcclient
+import tritonclient.utils.shared_memory as shm
+from tritonclient.utils import InferenceServerException
+
+from processing import input_spec, preprocess, postprocess
+
+INPUT_NAMES = ["images"]
+OUTPUT_NAMES = ["num_dets", "det_boxes", "det_scores", "det_classes"]
+
+
+class SharedMemorySlot:
+    """
+    Reusable system shared memory input and output regions for one request of up to `batch` frames.
+    Frames are preprocessed straight into the input region and only region handles cross the wire.
+    """
+
+    def __init__(self, triton_client, name, input_shape, batch=1, topk=100, uint8=False, nhwc=False):
+        self.triton_client = triton_client
+        self.input_name, self.output_name = f"{name}_input", f"{name}_output"
+        self.frame_shape, self.dtype, self.datatype = input_spec(input_shape, uint8, nhwc)
+        self.output_shapes = {OUTPUT_NAMES[0]: (np.int32, (1,)),
+                              OUTPUT_NAMES[1]: (np.float32, (topk, 4)),
+                              OUTPUT_NAMES[2]: (np.float32, (topk,)),
+                              OUTPUT_NAMES[3]: (np.int32, (topk,))}
+        self.offsets, size = {}, 0
+        for output, (dtype, shape) in self.output_shapes.items():
+            self.offsets[output] = size
+            size += batch * int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.regions = []
+
+        input_size = batch * int(np.prod(self.frame_shape)) * np.dtype(self.dtype).itemsize
+        try:
+            for region, byte_size in ((self.input_name, input_size), (self.output_name, size)):
+                self.regions.append(shm.create_shared_memory_region(region, f"/{region}", byte_size))
+                triton_client.register_system_shared_memory(region, f"/{region}", byte_size)
+        except Exception:
+            self.close()
+            raise
+        self.buffer = shm.get_contents_as_numpy(self.regions[0], self.dtype, (batch, *self.frame_shape))
+
+    def inputs(self, n):
+        inputs = [grpcclient.InferInput(INPUT_NAMES[0], [n, *self.frame_shape], self.datatype)]
+        inputs[0].set_shared_memory(self.input_name, self.buffer[:n].nbytes)
+        return inputs
+
+    def outputs(self, n):
+        outputs = []
+        for output, (dtype, shape) in self.output_shapes.items():
+            outputs.append(grpcclient.InferRequestedOutput(output))
+            outputs[-1].set_shared_memory(self.output_name, n * int(np.prod(shape)) * np.dtype(dtype).itemsize,
+                                          offset=self.offsets[output])
+        return outputs
+
+    def results(self, n):
+        # Copies of the outputs of the last request, the region is reused by the next one
+        return [shm.get_contents_as_numpy(self.regions[1], dtype, (n, *shape), offset=self.offsets[output]).copy()
+                for output, (dtype, shape) in self.output_shapes.items()]
+
+    def close(self):
+        for region, handle in zip((self.input_name, self.output_name), self.regions):
+            try:
+                self.triton_client.unregister_system_shared_memory(region)
+            except InferenceServerException:
+                pass
+            shm.destroy_shared_memory_region(handle)
+        self.regions = []
+
+
+class InferencePipeline:
+    """
+    Pipelined video inference with the gRPC async_infer API.
+    Frames are preprocessed and grouped into requests of `batch` frames, up to `in_flight` requests are outstanding
+    at once and results are handed back strictly in frame order, reordered by request sequence number.
+    With `shared_memory` every in-flight request owns a SharedMemorySlot, falling back to regular gRPC transport if
+    the server can not map the regions (e.g. it runs on another host).
+    `uint8`, `nhwc` and `bgr` describe the input of models exported with the matching export.py flags.
+    """
+
+    def __init__(self, triton_client, model, input_shape, in_flight=4, batch=1, client_timeout=None,
+                 shared_memory=False, uint8=False, nhwc=False, bgr=False):
+        self.triton_client = triton_client
+        self.model = model
+        self.input_shape = input_shape
+        self.in_flight = max(in_flight, 1)
+        self.batch = max(batch, 1)
+        self.client_timeout = client_timeout
+        self.input_format = dict(uint8=uint8, nhwc=nhwc, bgr=bgr)
+        self.datatype = input_spec(input_shape, uint8, nhwc)[2]
+        self.cond = Condition()
+        self.slot = None  # slot of the request being assembled
+        self.pending = []  # (frame, buffer) of the request being assembled
+        self.done = {}  # sequence number -> (frames, outputs, error)
+        self.sent = 0  # sequence number of the next request
+        self.emitted = 0  # sequence number of the next request to hand back
+        self.outputs = [grpcclient.InferRequestedOutput(name) for name in OUTPUT_NAMES]
+
+        slots = [None] * self.in_flight
+        if shared_memory:
+            try:
+                for i in range(self.in_flight):
+                    slots[i] = SharedMemorySlot(triton_client, f"yolov7_{os.getpid()}_{i}", input_shape, self.batch,
+                                                uint8=uint8, nhwc=nhwc)
+            except Exception as e:
+                print(f"WARNING: system shared memory unavailable, falling back to gRPC transport: {e}")
+                for slot in slots:
+                    if slot is not None:
+                        slot.close()
+                slots = [None] * self.in_flight
+        self.shared_memory = slots[0] is not None
+        self.free = Queue()  # free slots, bounds the number of in-flight requests
+        for slot in slots:
+            self.free.put(slot)
+
+    def put(self, frame):
+        """
+        Queue a frame, sending a request once `batch` frames are pending.
+        :return: list of (frame, detected_objects) that completed in order so far
+        """
+        if not self.pending:
+            self.slot = self.free.get()
+        out = self.slot.buffer[len(self.pending)] if self.shared_memory else None
+        self.pending.append((frame, preprocess(frame, self.input_shape, out=out, **self.input_format)))
+        if len(self.pending) == self.batch:
+            self.send()
+        return list(self.ready(block=False))
+
+    def drain(self):
+        """
+        Send any partial batch and wait for all outstanding requests.
+        :return: generator of the remaining (frame, detected_objects) in order
+        """
+        if self.pending:
+            self.send()
+        return self.ready(block=True)
+
+    def close(self):
+        # Unregister and release the shared memory regions, all requests must have completed
+        for _ in range(self.in_flight):
+            slot = self.free.get()
+            if slot is not None:
+                slot.close()
+
+    def send(self):
+        frames, buffers = zip(*self.pending)
+        slot, n = self.slot, len(frames)
+        self.pending, self.slot = [], None
+        if slot is not None:
+            inputs, outputs = slot.inputs(n), slot.outputs(n)
+        else:
+            batch = np.stack(buffers, axis=0)
+            inputs, outputs = [grpcclient.InferInput(INPUT_NAMES[0], list(batch.shape), self.datatype)], self.outputs
+            inputs[0].set_data_from_numpy(batch)
+
+        self.triton_client.async_infer(model_name=self.model,
+                                       inputs=inputs,
+                                       callback=partial(self.callback, self.sent, frames, slot),
+                                       outputs=outputs,
+                                       client_timeout=self.client_timeout)
+        self.sent += 1
+
+    def callback(self, seq, frames, slot, result, error):
+        outputs = None
+        if not error:
+            outputs = slot.results(len(frames)) if slot is not None else [result.as_numpy(x) for x in OUTPUT_NAMES]
+        with self.cond:
+            self.done[seq] = frames, outputs, error
+            self.cond.notify_all()
+        self.free.put(slot)
+
+    def ready(self, block=False):
+        while True:
+            with self.cond:
+                if block:
+                    self.cond.wait_for(lambda: self.emitted in self.done or self.emitted == self.sent)
+                if self.emitted not in self.done:
+                    return
+                frames, outputs, error = self.done.pop(self.emitted)
+                self.emitted += 1
+            if error:
+                raise error
+
+            num_dets, det_boxes, det_scores, det_classes = outputs
+            for i, frame in enumerate(frames):
+                s = slice(i, i + 1)
+                yield frame, postprocess(num_dets[s], det_boxes[s], det_scores[s], det_classes[s],
+                                         frame.shape[1], frame.shape[0], self.input_shape)
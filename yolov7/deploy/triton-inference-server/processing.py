@@ -3,7 +3,12 @@ from boundingbox import BoundingBox
 import cv2
 import numpy as np
 
-def preprocess(img, input_shape, letter_box=True):
+def input_spec(input_shape, uint8=False, nhwc=False):
+    # Per-frame (shape, numpy dtype, Triton datatype) of the model input, see export.py --uint8-input / --nhwc
+    shape = (input_shape[0], input_shape[1], 3) if nhwc else (3, input_shape[0], input_shape[1])
+    return (shape, np.uint8, "UINT8") if uint8 else (shape, np.float32, "FP32")
+
+def preprocess(img, input_shape, letter_box=True, out=None, uint8=False, nhwc=False, bgr=False):
     if letter_box:
         img_h, img_w, _ = img.shape
         new_h, new_w = input_shape[0], input_shape[1]
@@ -20,7 +25,16 @@ def preprocess(img, input_shape, letter_box=True):
     else:
         img = cv2.resize(img, (input_shape[1], input_shape[0]))
 
-    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if not bgr:  # a model exported with --bgr swaps channels itself
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    if uint8:  # the model normalizes on the server
+        img = img if nhwc else img.transpose((2, 0, 1))
+        if out is not None:
+            out[...] = img
+            return out
+        return np.ascontiguousarray(img)
+    if out is not None:  # write in place, e.g. into a shared memory region
+        return np.divide(img.transpose((2, 0, 1)), np.float32(255.0), out=out)
     img = img.transpose((2, 0, 1)).astype(np.float32)
     img /= 255.0
     return img
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import argparse
+import time
+from concurrent import futures
+from multiprocessing import shared_memory
+
+import grpc
+import numpy as np
+
+from tritonclient.grpc import service_pb2, service_pb2_grpc
+
+TOPK = 100
+
+
+class StubInferenceService(service_pb2_grpc.GRPCInferenceServiceServicer):
+    """
+    Stand-in for Triton serving an End2End YOLOv7 model, for client throughput tests without a GPU.
+    Accepts FP32 `images` [N, 3, H, W], or UINT8 [N, 3, H, W] / [N, H, W, 3] as exported with --uint8-input, and
+    answers `num_dets`, `det_boxes`, `det_scores` and `det_classes` after a fixed per-request latency plus a per-image
+    latency, emulating a server-side batched engine. Tensors may be passed inline or through registered system shared
+    memory regions.
+    """
+
+    def __init__(self, latency=0.02, image_latency=0.002, dets=10):
+        self.latency = latency
+        self.image_latency = image_latency
+        self.dets = dets
+        self.regions = {}  # name -> (SharedMemory, offset, byte_size)
+
+    def SystemSharedMemoryRegister(self, request, context):
+        try:
+            region = shared_memory.SharedMemory(request.key.lstrip('/'))
+        except FileNotFoundError:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Unable to open shared memory region '{request.key}'")
+        self.regions[request.name] = region, request.offset, request.byte_size
+        return service_pb2.SystemSharedMemoryRegisterResponse()
+
+    def SystemSharedMemoryUnregister(self, request, context):
+        region = self.regions.pop(request.name, None)
+        if region:
+            region[0].close()
+        return service_pb2.SystemSharedMemoryUnregisterResponse()
+
+    def shared_memory(self, tensor):
+        # Returns the (buffer, byte_size) a tensor's shared memory parameters refer to, or None if passed inline
+        p = tensor.parameters
+        if 'shared_memory_region' not in p:
+            return None
+        region, offset, _ = self.regions[p['shared_memory_region'].string_param]
+        offset += p['shared_memory_offset'].int64_param if 'shared_memory_offset' in p else 0
+        return region.buf[offset:offset + p['shared_memory_byte_size'].int64_param]
+
+    def ServerLive(self, request, context):
+        return service_pb2.ServerLiveResponse(live=True)
+
+    def ServerReady(self, request, context):
+        return service_pb2.ServerReadyResponse(ready=True)
+
+    def ModelReady(self, request, context):
+        return service_pb2.ModelReadyResponse(ready=True)
+
+    def ModelInfer(self, request, context):
+        n, *shape = request.inputs[0].shape
+        h, w = shape[1:] if shape[0] == 3 else shape[:2]  # NCHW or NHWC
+        dtype = np.uint8 if request.inputs[0].datatype == "UINT8" else np.float32
+        buffer = self.shared_memory(request.inputs[0])
+        images = np.frombuffer(buffer if buffer is not None else request.raw_input_contents[0], dtype=dtype)
+        assert images.size == n * 3 * h * w, f"Unexpected input size {images.size}"
+        time.sleep(self.latency + self.image_latency * n)
+
+        num_dets = np.full((n, 1), self.dets, dtype=np.int32)
+        det_boxes = np.zeros((n, TOPK, 4), dtype=np.float32)
+        det_boxes[:, :self.dets] = np.random.uniform(0, 0.5, (n, self.dets, 4)) * [w, h, w, h]
+        det_boxes[:, :self.dets, 2:] += det_boxes[:, :self.dets, :2]  # x1y1x2y2
+        det_scores = np.zeros((n, TOPK), dtype=np.float32)
+        det_scores[:, :self.dets] = np.random.uniform(0.35, 1.0, (n, self.dets))
+        det_classes = np.zeros((n, TOPK), dtype=np.int32)
+        det_classes[:, :self.dets] = np.random.randint(0, 80, (n, self.dets))
+
+        response = service_pb2.ModelInferResponse(model_name=request.model_name, id=request.id)
+        requested = {x.name: self.shared_memory(x) for x in request.outputs}
+        for name, x, datatype in (("num_dets", num_dets, "INT32"), ("det_boxes", det_boxes, "FP32"),
+                                  ("det_scores", det_scores, "FP32"), ("det_classes", det_classes, "INT32")):
+            output = response.outputs.add(name=name, datatype=datatype, shape=x.shape)
+            buffer = requested.get(name)
+            if buffer is not None:  # write into the client's region
+                np.frombuffer(buffer, dtype=x.dtype)[:x.size] = x.ravel()
+                output.parameters['shared_memory_byte_size'].int64_param = x.nbytes
+            else:
+                response.raw_output_contents.append(x.tobytes())
+        return response
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p',
+                        '--port',
+                        type=int,
+                        required=False,
+                        default=8001,
+                        help='gRPC port, default 8001')
+    parser.add_argument('-l',
+                        '--latency',
+                        type=float,
+                        required=False,
+                        default=0.02,
+                        help='Emulated latency per request in seconds, default 0.02')
+    parser.add_argument('--image-latency',
+                        type=float,
+                        required=False,
+                        default=0.002,
+                        help='Emulated additional latency per image in a request in seconds, default 0.002')
+    parser.add_argument('-w',
+                        '--workers',
+                        type=int,
+                        required=False,
+                        default=8,
+                        help='Number of requests served concurrently, default 8')
+
+    FLAGS = parser.parse_args()
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=FLAGS.workers),
+                         options=[('grpc.max_receive_message_length', -1), ('grpc.max_send_message_length', -1)])
+    service_pb2_grpc.add_GRPCInferenceServiceServicer_to_server(
+        StubInferenceService(FLAGS.latency, FLAGS.image_latency), server)
+    server.add_insecure_port(f'[::]:{FLAGS.port}')
+    server.start()
+    print(f"Stub inference server listening on port {FLAGS.port}")
+    server.wait_for_termination()
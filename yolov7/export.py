@@ -10,7 +10,7 @@ import torch.nn as nn
 from torch.utils.mobile_optimizer import optimize_for_mobile
 
 import models
-from models.experimental import attempt_load, End2End
+from models.experimental import attempt_load, End2End, ImageInput
 from utils.activations import Hardswish, SiLU
 from utils.general import set_logging, check_img_size
 from utils.torch_utils import select_device
@@ -34,10 +34,14 @@ if __name__ == '__main__':
     parser.add_argument('--include-nms', action='store_true', help='export end2end onnx')
     parser.add_argument('--fp16', action='store_true', help='CoreML FP16 half-precision export')
     parser.add_argument('--int8', action='store_true', help='CoreML INT8 quantization')
+    parser.add_argument('--uint8-input', action='store_true', help='onnx takes uint8 images, normalized in the graph')
+    parser.add_argument('--nhwc', action='store_true', help='onnx uint8 input in NHWC layout, requires --uint8-input')
+    parser.add_argument('--bgr', action='store_true', help='onnx uint8 input in BGR channel order, requires --uint8-input')
     opt = parser.parse_args()
     opt.img_size *= 2 if len(opt.img_size) == 1 else 1  # expand
     opt.dynamic = opt.dynamic and not opt.end2end
     opt.dynamic = False if opt.dynamic_batch else opt.dynamic
+    assert opt.uint8_input or not (opt.nhwc or opt.bgr), '--nhwc and --bgr require --uint8-input'
     print(opt)
     set_logging()
     t = time.time()
@@ -123,7 +127,8 @@ if __name__ == '__main__':
         output_names = ['classes', 'boxes'] if y is None else ['output']
         dynamic_axes = None
         if opt.dynamic:
-            dynamic_axes = {'images': {0: 'batch', 2: 'height', 3: 'width'},  # size(1,3,640,640)
+            dynamic_axes = {'images': {0: 'batch', 1: 'height', 2: 'width'} if opt.nhwc else  # size(1,640,640,3)
+                            {0: 'batch', 2: 'height', 3: 'width'},  # size(1,3,640,640)
              'output': {0: 'batch', 2: 'y', 3: 'x'}}
         if opt.dynamic_batch:
             opt.batch_size = 'batch'
@@ -155,6 +160,10 @@ if __name__ == '__main__':
                     output_names = ['output']
             else:
                 model.model[-1].concat = True
+        if opt.uint8_input:  # cast and normalize (and reorder) raw uint8 images in the graph
+            print('Prepending uint8 %s %s input stage...' % ('NHWC' if opt.nhwc else 'NCHW', 'BGR' if opt.bgr else 'RGB'))
+            model = ImageInput(model, nhwc=opt.nhwc, bgr=opt.bgr)
+            img = (img.permute(0, 2, 3, 1) if opt.nhwc else img).to(torch.uint8)
 
         torch.onnx.export(model, img, f, verbose=False, opset_version=12, input_names=['images'],
                           output_names=output_names,
@@ -12,7 +12,7 @@ from torchvision.ops import DeformConv2d
 from PIL import Image
 from torch.cuda import amp
 
-from utils.datasets import letterbox
+from utils.datasets import letterbox_batch
 from utils.general import non_max_suppression, make_divisible, scale_coords, increment_path, xyxy2xywh
 from utils.plots import color_list, plot_one_box
 from utils.torch_utils import time_synchronized
@@ -912,10 +912,8 @@ class autoShape(nn.Module):
             shape1.append([y * g for y in s])
             imgs[i] = im  # update
         shape1 = [make_divisible(x, int(self.stride.max())) for x in np.stack(shape1, 0).max(0)]  # inference shape
-        x = [letterbox(im, new_shape=shape1, auto=False)[0] for im in imgs]  # pad
-        x = np.stack(x, 0) if n > 1 else x[0][None]  # stack
-        x = np.ascontiguousarray(x.transpose((0, 3, 1, 2)))  # BHWC to BCHW
-        x = torch.from_numpy(x).to(p.device).type_as(p) / 255.  # uint8 to fp16/32
+        x = letterbox_batch(imgs, new_shape=shape1, auto=False, device=p.device, half=p.dtype == torch.float16,
+                            bgr=False)[0]  # pad, BHWC to BCHW, uint8 to fp16/32 on device
         t.append(time_synchronized())
 
         with amp.autocast(enabled=p.device.type != 'cpu'):
@@ -223,6 +223,23 @@ class ONNX_TRT(nn.Module):
         return num_det, det_boxes, det_scores, det_classes
 
 
+class ImageInput(nn.Module):
+    '''raw image input stage: uint8 NCHW/NHWC, RGB/BGR images to the 0-1 float RGB NCHW tensor the model expects.'''
+    def __init__(self, model, nhwc=False, bgr=False):
+        super().__init__()
+        self.model = model
+        self.nhwc = nhwc
+        self.bgr = bgr
+
+    def forward(self, x):
+        if self.nhwc:
+            x = x.permute(0, 3, 1, 2)  # NHWC to NCHW
+        if self.bgr:
+            x = x[:, [2, 1, 0]]  # BGR to RGB
+        x = x.float() * (1 / 255.)  # uint8 to float 0-1, on the inference server
+        return self.model(x)
+
+
 class End2End(nn.Module):
     '''export onnx or tensorrt model with NMS operation.'''
     def __init__(self, model, max_obj=100, iou_thres=0.45, score_thres=0.25, max_wh=None, device=None, n_classes=80):
@@ -1,4 +1,5 @@
 import argparse
+import inspect
 import logging
 import sys
 from copy import deepcopy
@@ -6,12 +7,13 @@ from copy import deepcopy
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
 logger = logging.getLogger(__name__)
 import torch
+import torch.utils.checkpoint
 from models.common import *
 from models.experimental import *
 from utils.autoanchor import check_anchor_order
 from utils.general import make_divisible, check_file, set_logging
 from utils.torch_utils import time_synchronized, fuse_conv_and_bn, model_info, scale_img, initialize_weights, \
-    select_device, copy_attr
+    select_device, copy_attr, compile_model, cpu_memory
 from utils.loss import SigmoidBin
 
 try:
@@ -42,7 +44,8 @@ class Detect(nn.Module):
     def forward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:  # no module state write while training, which would break a compiled graph
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -119,7 +122,8 @@ class IDetect(nn.Module):
     def forward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
@@ -140,7 +144,8 @@ class IDetect(nn.Module):
     def fuseforward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -248,7 +253,8 @@ class IKeypoint(nn.Module):
     def forward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             if self.nkpt is None or self.nkpt==0:
                 x[i] = self.im[i](self.m[i](self.ia[i](x[i])))  # conv
@@ -334,7 +340,8 @@ class IAuxDetect(nn.Module):
     def forward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
@@ -364,7 +371,8 @@ class IAuxDetect(nn.Module):
     def fuseforward(self, x):
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -466,7 +474,8 @@ class IBin(nn.Module):
         
         # x = x.copy()  # for profiling
         z = []  # inference output
-        self.training |= self.export
+        if self.export:
+            self.training = True
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
@@ -573,8 +582,9 @@ class Model(nn.Module):
             self._initialize_biases_kpt()  # only run once
             # print('Strides: %s' % m.stride.tolist())
 
-        # Init weights, biases
+        # Init weights, biases, activation checkpointing once the stride forward has run
         initialize_weights(self)
+        self.set_checkpoint(self.yaml.get('checkpoint'))
         self.info()
         logger.info('')
 
@@ -600,6 +610,10 @@ class Model(nn.Module):
 
     def forward_once(self, x, profile=False):
         y, dt = [], []  # outputs
+        if not hasattr(self.model[-1], 'drop'):  # model saved before liveness analysis
+            liveness(self.model)
+        if getattr(self, 'checkpoint', None) and self.training and torch.is_grad_enabled() and not profile:
+            return self.forward_checkpoint(x)
         for m in self.model:
             if m.f != -1:  # if not from previous layer
                 x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
@@ -625,11 +639,66 @@ class Model(nn.Module):
             x = m(x)  # run
             
             y.append(x if m.i in self.save else None)  # save output
+            for j in m.drop:  # release outputs that no later layer reads
+                y[j] = None
 
         if profile:
             print('%.1fms total' % sum(dt))
         return x
 
+    def forward_checkpoint(self, x):
+        # forward_once() running every self.checkpoint layer range under torch.utils.checkpoint, which keeps only the
+        # tensors entering and leaving the range and recomputes the rest in the backward pass
+        y, i = [], 0  # outputs, next layer
+        for a, b in self.checkpoint:
+            x = self.run_layers(x, y, i, a)
+            ins, outs = checkpoint_io(self.model, a, b)
+            x, *t = torch.utils.checkpoint.checkpoint(self.run_segment, a, b, ins, outs, x, *[y[j] for j in ins],
+                                                      use_reentrant=False)
+            y.extend([None] * (b - a))
+            for j, tj in zip(outs, t):
+                y[j] = tj
+            for m in self.model[a:b]:  # release inputs last read in the range
+                for j in m.drop:
+                    y[j] = None
+            i = b
+        return self.run_layers(x, y, i, len(self.model))
+
+    def run_segment(self, a, b, ins, outs, x, *t):
+        # Layers a to b from input x and the earlier outputs t of layers ins, returns x and the outputs of layers outs
+        y = [None] * a
+        for j, tj in zip(ins, t):
+            y[j] = tj
+        x = self.run_layers(x, y, a, b)
+        return (x, *[y[j] for j in outs])
+
+    def run_layers(self, x, y, a, b):
+        # Runs layers a to b of forward_once(), appending their saved outputs to y
+        for m in self.model[a:b]:
+            if m.f != -1:  # if not from previous layer
+                x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+            x = m(x)  # run
+            y.append(x if m.i in self.save else None)  # save output
+            for j in m.drop:  # release outputs that no later layer reads
+                y[j] = None
+        return x
+
+    def set_checkpoint(self, ranges=None):
+        # Layer ranges [start, end) that forward_once() runs under activation checkpointing in training, 'backbone' for
+        # the backbone split into its stages, None or [] for none
+        if ranges == 'backbone':
+            ranges = checkpoint_stages(self.model, 0, len(self.yaml['backbone']))
+        ranges = sorted((a, b) for a, b in ((int(a), int(b)) for a, b in ranges or []) if b > a)
+        assert all(b0 <= a1 for (_, b0), (a1, _) in zip(ranges, ranges[1:])), f'overlapping checkpoint ranges {ranges}'
+        assert not ranges or ranges[-1][1] < len(self.model), 'the Detect() layer cannot be checkpointed'
+        if ranges and 'use_reentrant' not in inspect.signature(torch.utils.checkpoint.checkpoint).parameters:
+            # reentrant checkpointing drops parameter gradients of ranges whose inputs need no grad, e.g. the image
+            logger.warning(f'Activation checkpointing requires torch>=1.11, disabled with torch {torch.__version__}')
+            ranges = []
+        self.checkpoint = ranges
+        if ranges:
+            logger.info(f'Activation checkpointing layers {ranges}')
+
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
         # cf = torch.bincount(torch.tensor(np.concatenate(dataset.labels, 0)[:, 0]).long(), minlength=nc) + 1.
@@ -810,14 +879,54 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         if i == 0:
             ch = []
         ch.append(c2)
+    liveness(layers)
     return nn.Sequential(*layers), sorted(save)
 
 
+def reads(m):
+    # Absolute indices of the saved outputs that layer m reads, the previous output read as -1 excluded
+    return [j % m.i for j in ([m.f] if isinstance(m.f, int) else m.f) if j != -1]
+
+
+def checkpoint_io(layers, a, b):
+    # Saved outputs from before layer a that layers a to b read, and outputs of layers a to b that later layers read
+    ins = sorted({j for m in layers[a:b] for j in reads(m) if j < a})
+    outs = sorted({j for m in layers[b:] for j in reads(m) if a <= j < b})
+    return ins, outs
+
+
+def checkpoint_stages(layers, a, b):
+    # Splits layers a to b into [start, end) stages at the layers where only the previous output enters from before,
+    # single layers joining the next stage
+    bounds = [a]
+    for i in range(a + 2, b):
+        if i - bounds[-1] > 1 and all(j >= i - 1 for m in layers[i:b] for j in reads(m)):
+            bounds.append(i)
+    return [[s, e] for s, e in zip(bounds, bounds[1:] + [b])]
+
+
+def liveness(layers):
+    # Attaches to every layer the indices of the saved outputs it reads last, which forward_once() releases after it
+    last = {j: m.i for m in layers for j in reads(m)}  # saved output index: last layer reading it
+    for m in layers:
+        m.drop = [j for j, i in last.items() if i == m.i]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cfg', type=str, default='yolor-csp-c.yaml', help='model.yaml')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--profile', action='store_true', help='profile model speed')
+    parser.add_argument('--memory', action='store_true', help='peak inference memory and time with and without output release')
+    parser.add_argument('--train-memory', action='store_true', help='training step memory and time with and without --checkpoint')
+    parser.add_argument('--train-speed', action='store_true', help='training step time eager and with torch.compile()')
+    parser.add_argument('--checkpoint', nargs='*', metavar='START:END', help='checkpointed layer ranges, backbone stages if none')
+    parser.add_argument('--check-loss', action='store_true', help='compare fused and per layer losses, gradients and loss step time')
+    parser.add_argument('--check-ota', action='store_true', help='SimOTA target assignment images/s')
+    parser.add_argument('--hyp', type=str, default='data/hyp.scratch.p5.yaml', help='--check-loss, --check-ota hyperparameters')
+    parser.add_argument('--labels', type=int, default=8, help='--check-loss, --check-ota labels per image')
+    parser.add_argument('--batch-size', type=int, default=16, help='--memory, --train-memory, --train-speed, --check-loss, --check-ota batch size')
+    parser.add_argument('--img-size', type=int, default=640, help='--memory, --train-memory, --train-speed, --check-loss, --check-ota image size')
     opt = parser.parse_args()
     opt.cfg = check_file(opt.cfg)  # check file
     set_logging()
@@ -831,6 +940,123 @@ if __name__ == '__main__':
         img = torch.rand(1, 3, 640, 640).to(device)
         y = model(img, profile=True)
 
+    if opt.memory:  # peak memory of an inference pass, releasing dead layer outputs or keeping them all
+        cuda = device.type == 'cuda'  # else peak resident memory growth of this process
+        model.eval()
+        img = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size, device=device)
+        drop = [m.drop for m in model.model]
+        for release in True, False:
+            for m, d in zip(model.model, drop):
+                m.drop = d if release else []
+            if cuda:
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device) / 1E9
+            else:
+                base = cpu_memory(reset=True)[0]
+            t = time_synchronized()
+            with torch.no_grad():
+                model(img)
+            dt = (time_synchronized() - t) * 1000
+            peak = (torch.cuda.max_memory_allocated(device) / 1E9 if cuda else cpu_memory()[1]) - base
+            print(f"{'release' if release else 'keep':>10s}{peak:10.3f}GB{dt:10.1f}ms  batch {opt.batch_size} at "
+                  f"{opt.img_size} on {device.type}")
+        for m, d in zip(model.model, drop):
+            m.drop = d
+
+    if opt.train_memory:  # peak memory and time of a training step, with and without activation checkpointing
+        cuda = device.type == 'cuda'  # else peak resident memory growth of this process
+        model.train()
+        img = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size, device=device)
+        for ranges in [x.split(':') for x in opt.checkpoint or []] or 'backbone', None:
+            model.set_checkpoint(ranges)
+            for i in range(4):  # 1 warmup step, 3 timed
+                if i == 1:
+                    if cuda:
+                        torch.cuda.reset_peak_memory_stats(device)
+                    else:
+                        base = cpu_memory(reset=True)[0]
+                    t = time_synchronized()
+                with torch.cuda.amp.autocast(enabled=cuda):
+                    y = model(img)
+                sum(yi.float().sum() for yi in y).backward()
+                model.zero_grad(set_to_none=True)
+            dt = (time_synchronized() - t) / 3 * 1000
+            peak = torch.cuda.max_memory_allocated(device) / 1E9 if cuda else cpu_memory()[1] - base
+            print(f"{'checkpoint' if ranges else 'none':>10s}{peak:10.3f}GB{dt:10.1f}ms  batch {opt.batch_size} at "
+                  f"{opt.img_size} on {device.type}")
+        model.set_checkpoint(None)
+
+    if opt.train_speed:  # forward and backward step time, eager and compiled as by train.py --compile
+        model.train()
+        img = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size, device=device)
+        for name, f in ('eager', model), ('compiled', compile_model(model, [img.shape[2:]], opt.batch_size)):
+            for i in range(6):  # 1 warmup step, 5 timed
+                if i == 1:
+                    t = time_synchronized()
+                y = f(img)
+                sum(yi.float().sum() for yi in y).backward()
+                model.zero_grad(set_to_none=True)
+            dt = (time_synchronized() - t) / 5 * 1000
+            print(f'{name:>10s}{dt:10.1f}ms  batch {opt.batch_size} at {opt.img_size} on {device.type}')
+
+    if opt.check_loss or opt.check_ota:  # a random batch with random targets
+        import yaml
+        from utils.loss import ComputeLoss, ComputeLossOTA, ComputeLossAuxOTA
+        with open(check_file(opt.hyp)) as f:
+            model.hyp = yaml.load(f, Loader=yaml.SafeLoader)
+        model.gr, model.nc = 1.0, model.yaml['nc']
+        model.train()
+        torch.manual_seed(0)
+        img = torch.rand(opt.batch_size, 3, opt.img_size, opt.img_size, device=device)
+        n = opt.labels * opt.batch_size
+        targets = torch.cat((torch.randint(opt.batch_size, (n, 1)).float(), torch.randint(model.nc, (n, 1)).float(),
+                             torch.rand(n, 2) * 0.8 + 0.1, torch.rand(n, 2) * 0.3 + 0.01), 1).to(device)  # xywh
+        aux = isinstance(model.model[-1], IAuxDetect)
+
+    if opt.check_ota:  # ComputeLossOTA / ComputeLossAuxOTA.build_targets throughput
+        compute_loss = (ComputeLossAuxOTA if aux else ComputeLossOTA)(model)
+        with torch.no_grad():
+            pred = model(img)
+            for i in range(6):  # 1 warmup pass, 5 timed
+                if i == 1:
+                    t = time_synchronized()
+                compute_loss.build_targets(pred[:compute_loss.nl], targets, img)
+            dt = (time_synchronized() - t) / 5
+        print(f'{type(compute_loss).__name__:>20s}{opt.batch_size / dt:10.1f} images/s  batch {opt.batch_size} at '
+              f'{opt.img_size}, {opt.labels} labels per image on {device.type}')
+
+    if opt.check_loss:  # train.py --fused-loss against the per layer losses
+        for loss in ComputeLoss, ComputeLossAuxOTA if aux else ComputeLossOTA:
+            results = []
+            for fused in False, True:
+                compute_loss = loss(model, fused=fused)
+                assert bool(compute_loss.fused) == fused, f'{opt.hyp} can not be fused, see FusedLoss'
+                model.zero_grad(set_to_none=True)
+                pred = model(img)
+                l, items = compute_loss(pred, targets) if loss is ComputeLoss else compute_loss(pred, targets, img)
+                l.backward()
+                results.append((items, [x.grad.clone() for x in model.parameters() if x.grad is not None]))
+            (items, grads), (items_fused, grads_fused) = results
+            dl = ((items - items_fused).abs() / items.abs().clamp(min=1e-12)).max()
+            dg = max(((a - b).abs().max() / a.abs().max().clamp(min=1e-12)).item() for a, b in zip(grads, grads_fused))
+            print(f'{loss.__name__:>20s}  loss {items.tolist()} vs {items_fused.tolist()}, max relative difference '
+                  f'loss {dl:.3g}, gradients {dg:.3g}')
+            with torch.no_grad():
+                pred = model(img)
+            for fused in False, True:  # loss forward and backward into the predictions, target assignment included
+                compute_loss = loss(model, fused=fused)
+                for i in range(11):  # 1 warmup step, 10 timed
+                    if i == 1:
+                        t = time_synchronized()
+                    p = [x.clone().requires_grad_() for x in pred]
+                    l, _ = compute_loss(p, targets) if loss is ComputeLoss else compute_loss(p, targets, img)
+                    l.backward()
+                dt = (time_synchronized() - t) / 10 * 1000
+                print(f"{'fused' if fused else 'per layer':>20s}{dt:10.1f}ms  loss step, batch {opt.batch_size} at "
+                      f"{opt.img_size} on {device.type}")
+        model.zero_grad(set_to_none=True)
+
     # Profile
     # img = torch.rand(8 if torch.cuda.is_available() else 1, 3, 640, 640).to(device)
     # y = model(img, profile=True)
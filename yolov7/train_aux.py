@@ -25,14 +25,15 @@ import test  # import test.py to get mAP after each epoch
 from models.experimental import attempt_load
 from models.yolo import Model
 from utils.autoanchor import check_anchors
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, LoadShards, BatchAugment, DevicePrefetcher, pad_batch
 from utils.general import labels_to_class_weights, increment_path, labels_to_image_weights, init_seeds, \
     fitness, strip_optimizer, get_latest_run, check_dataset, check_file, check_git_status, check_img_size, \
-    check_requirements, print_mutation, set_logging, one_cycle, colorstr
+    check_requirements, print_mutation, set_logging, one_cycle, colorstr, make_divisible
 from utils.google_utils import attempt_download
 from utils.loss import ComputeLoss, ComputeLossAuxOTA
 from utils.plots import plot_images, plot_labels, plot_results, plot_evolution
-from utils.torch_utils import ModelEMA, select_device, intersect_dicts, torch_distributed_zero_first, is_parallel
+from utils.torch_utils import ModelEMA, select_device, intersect_dicts, torch_distributed_zero_first, is_parallel, \
+    compile_model
 from utils.wandb_logging.wandb_utils import WandbLogger, check_wandb_resume
 
 logger = logging.getLogger(__name__)
@@ -93,6 +94,8 @@ def train(hyp, opt, device, tb_writer=None):
         logger.info('Transferred %g/%g items from %s' % (len(state_dict), len(model.state_dict()), weights))  # report
     else:
         model = Model(opt.cfg, ch=3, nc=nc, anchors=hyp.get('anchors')).to(device)  # create
+    if opt.checkpoint is not None:  # activation checkpointing, of the backbone stages if no ranges are given
+        model.set_checkpoint([x.split(':') for x in opt.checkpoint] or 'backbone')
     with torch_distributed_zero_first(rank):
         check_dataset(data_dict)  # check
     train_path = data_dict['train']
@@ -242,10 +245,17 @@ def train(hyp, opt, device, tb_writer=None):
         logger.info('Using SyncBatchNorm()')
 
     # Trainloader
+    batch_augment = None
+    if opt.gpu_augment:  # workers only decode and letterbox, batches are augmented on device
+        assert not (opt.rect or opt.quad), '--gpu-augment needs square batches, not --rect or --quad'
+        batch_augment = BatchAugment(hyp, imgsz)
     dataloader, dataset = create_dataloader(train_path, imgsz, batch_size, gs, opt,
-                                            hyp=hyp, augment=True, cache=opt.cache_images, rect=opt.rect, rank=rank,
-                                            world_size=opt.world_size, workers=opt.workers,
-                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '))
+                                            hyp=hyp, augment=not opt.gpu_augment, cache=opt.cache_images,
+                                            rect=opt.rect, rank=rank, world_size=opt.world_size, workers=opt.workers,
+                                            image_weights=opt.image_weights, quad=opt.quad, prefix=colorstr('train: '),
+                                            cache_budget=opt.cache_budget, cache_compress=opt.cache_compress,
+                                            shuffle=opt.gpu_augment, gpu_augment=opt.gpu_augment,
+                                            epoch=start_epoch)  # sampler epoch, also of a --resume
     mlc = np.concatenate(dataset.labels, 0)[:, 0].max()  # max label class
     nb = len(dataloader)  # number of batches
     assert mlc < nc, 'Label class %g exceeds nc=%g in %s. Possible class labels are 0-%g' % (mlc, nc, opt.data, nc - 1)
@@ -289,6 +299,20 @@ def train(hyp, opt, device, tb_writer=None):
     model.class_weights = labels_to_class_weights(dataset.labels, nc).to(device) * nc  # attach class weights
     model.names = names
 
+    # Compiled training, multi-scale and rect batches are padded up to --compile-step multiples to bound the graph count
+    forward = model
+    if opt.compile:
+        assert not opt.quad, '--compile does not support --quad'
+        step = make_divisible(opt.compile_step, gs)
+        sizes = list(range(math.ceil(imgsz * 0.5 / step) * step, int(imgsz * 1.5) // step * step + 1, step))
+        shapes = dataset.batch_shapes if opt.rect and hasattr(dataset, 'batch_shapes') else [(imgsz, imgsz)]
+        if opt.multi_scale:  # every batch shape at every size, scaled as in the training loop
+            shapes = [[math.ceil(x * (sz / max(s)) / gs) * gs for x in s] for s in shapes for sz in sizes]
+        if opt.multi_scale or opt.rect:
+            shapes = [[make_divisible(x, step) for x in s] for s in shapes]
+        n = len(dataset) if isinstance(dataset, LoadShards) else len(dataloader.sampler)  # samples per rank
+        forward = compile_model(model, shapes, batch_size, last=n % batch_size, amp=cuda)  # and the last batch
+
     # Start training
     t0 = time.time()
     nw = max(round(hyp['warmup_epochs'] * nb), 1000)  # number of warmup iterations, max(3 epochs, 1k iterations)
@@ -297,8 +321,8 @@ def train(hyp, opt, device, tb_writer=None):
     results = (0, 0, 0, 0, 0, 0, 0)  # P, R, mAP@.5, mAP@.5-.95, val_loss(box, obj, cls)
     scheduler.last_epoch = start_epoch - 1  # do not move
     scaler = amp.GradScaler(enabled=cuda)
-    compute_loss_ota = ComputeLossAuxOTA(model)  # init loss class
-    compute_loss = ComputeLoss(model)  # init loss class
+    compute_loss_ota = ComputeLossAuxOTA(model, fused=opt.fused_loss)  # init loss class
+    compute_loss = ComputeLoss(model, fused=opt.fused_loss)  # init loss class
     logger.info(f'Image sizes {imgsz} train, {imgsz_test} test\n'
                 f'Using {dataloader.num_workers} dataloader workers\n'
                 f'Logging results to {save_dir}\n'
@@ -309,33 +333,29 @@ def train(hyp, opt, device, tb_writer=None):
 
         # Update image weights (optional)
         if opt.image_weights:
-            # Generate indices
-            if rank in [-1, 0]:
-                cw = model.class_weights.cpu().numpy() * (1 - maps) ** 2 / nc  # class weights
-                iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw)  # image weights
-                dataset.indices = random.choices(range(dataset.n), weights=iw, k=dataset.n)  # rand weighted idx
-            # Broadcast if DDP
-            if rank != -1:
-                indices = (torch.tensor(dataset.indices) if rank == 0 else torch.zeros(dataset.n)).int()
-                dist.broadcast(indices, 0)
-                if rank != 0:
-                    dataset.indices = indices.cpu().numpy()
+            # Weights of the sampler, which draws the indices on every rank
+            cw = model.class_weights * torch.tensor((1 - maps) ** 2 / nc, device=device)  # class weights
+            if rank != -1:  # maps of rank 0
+                dist.broadcast(cw, 0)
+            iw = labels_to_image_weights(dataset.labels, nc=nc, class_weights=cw.cpu().numpy())  # image weights
+            dataloader.sampler.set_weights(iw)
 
         # Update mosaic border
         # b = int(random.uniform(0.25 * imgsz, 0.75 * imgsz + gs) // gs * gs)
         # dataset.mosaic_border = [b - imgsz, -b]  # height, width borders
 
         mloss = torch.zeros(4, device=device)  # mean losses
-        if rank != -1:
-            dataloader.sampler.set_epoch(epoch)
-        pbar = enumerate(dataloader)
+        if isinstance(dataset, LoadShards):
+            dataset.set_epoch(epoch)  # shard order, the sampler epoch is counted on by InfiniteDataLoader
+        pbar = enumerate(DevicePrefetcher(dataloader, device))  # imgs on device as float 0.0-1.0
         logger.info(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'box', 'obj', 'cls', 'total', 'labels', 'img_size'))
         if rank in [-1, 0]:
             pbar = tqdm(pbar, total=nb)  # progress bar
         optimizer.zero_grad()
-        for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+        for i, (imgs, targets, paths, shapes) in pbar:  # batch -------------------------------------------------------------
             ni = i + nb * epoch  # number integrated batches (since train start)
-            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0-255 to 0.0-1.0
+            if batch_augment:
+                imgs, targets = batch_augment(imgs, targets.to(device), shapes)
 
             # Warmup
             if ni <= nw:
@@ -350,15 +370,20 @@ def train(hyp, opt, device, tb_writer=None):
 
             # Multi-scale
             if opt.multi_scale:
-                sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
+                if opt.compile:
+                    sz = random.choice(sizes)  # compiled size
+                else:
+                    sz = random.randrange(imgsz * 0.5, imgsz * 1.5 + gs) // gs * gs  # size
                 sf = sz / max(imgs.shape[2:])  # scale factor
                 if sf != 1:
                     ns = [math.ceil(x * sf / gs) * gs for x in imgs.shape[2:]]  # new shape (stretched to gs-multiple)
                     imgs = F.interpolate(imgs, size=ns, mode='bilinear', align_corners=False)
+            if opt.compile and (opt.multi_scale or opt.rect):  # pad to a compiled shape
+                imgs, targets = pad_batch(imgs, targets, [make_divisible(x, step) for x in imgs.shape[2:]])
 
             # Forward
             with amp.autocast(enabled=cuda):
-                pred = model(imgs)  # forward
+                pred = forward(imgs)  # forward
                 loss, loss_items = compute_loss_ota(pred, targets.to(device), imgs)  # loss scaled by batch_size
                 if rank != -1:
                     loss *= opt.world_size  # gradient averaged between devices in DDP mode
@@ -397,6 +422,8 @@ def train(hyp, opt, device, tb_writer=None):
 
             # end batch ------------------------------------------------------------------------------------------------
         # end epoch ----------------------------------------------------------------------------------------------------
+        if rank in [-1, 0] and dataset.img_lru is not None:
+            logger.info(dataset.img_lru.report())
 
         # Scheduler
         lr = [x['lr'] for x in optimizer.param_groups]  # for tensorboard
@@ -537,7 +564,14 @@ if __name__ == '__main__':
     parser.add_argument('--noautoanchor', action='store_true', help='disable autoanchor check')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', nargs='?', const='ram', default=False, help='cache images in shared "ram" (default) or on "disk"')
+    parser.add_argument('--cache-budget', type=float, default=0, help='LRU image cache size in GB, when not --cache-images')
+    parser.add_argument('--cache-compress', choices=['png', 'jpg'], help='store LRU cached images as png or jpg bytes')
+    parser.add_argument('--gpu-augment', action='store_true', help='augment batches on device instead of in dataloader workers')
+    parser.add_argument('--compile', action='store_true', help='torch.compile() the model, compiling every batch shape before training')
+    parser.add_argument('--compile-step', type=int, default=64, help='--compile multi-scale and rect shape step, pixels')
+    parser.add_argument('--checkpoint', nargs='*', metavar='START:END', help='activation checkpointing of layer ranges, backbone stages if none')
+    parser.add_argument('--fused-loss', action='store_true', help='compute the losses of all layers in fused TorchScript kernels')
     parser.add_argument('--image-weights', action='store_true', help='use weighted image selection for training')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--multi-scale', action='store_true', help='vary img-size +/- 50%%')
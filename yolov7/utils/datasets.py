@@ -1,27 +1,36 @@
 # Dataset utils and dataloaders
 
+import atexit
 import glob
+import json
 import logging
 import math
 import os
 import random
 import shutil
+import signal
+import tarfile
 import time
-from itertools import repeat
+import zlib
+from itertools import cycle, islice, repeat
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread, current_thread, main_thread
 
 import cv2
 import numpy as np
 import torch
 import torch.nn.functional as F
 from PIL import Image, ExifTags
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from tqdm import tqdm
 
 import pickle
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
 from copy import deepcopy
+from io import BytesIO
 #from pycocotools import mask as maskUtils
 from torchvision.utils import save_image
 from torchvision.ops import roi_pool, roi_align, ps_roi_pool, ps_roi_align
@@ -34,6 +43,7 @@ from utils.torch_utils import torch_distributed_zero_first
 help_url = 'https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 img_formats = ['bmp', 'jpg', 'jpeg', 'png', 'tif', 'tiff', 'dng', 'webp', 'mpo']  # acceptable image suffixes
 vid_formats = ['mov', 'avi', 'mp4', 'mpg', 'mpeg', 'm4v', 'wmv', 'mkv']  # acceptable video suffixes
+num_threads = os.cpu_count() or 1  # label verification processes
 logger = logging.getLogger(__name__)
 
 # Get orientation exif tag
@@ -47,6 +57,18 @@ def get_hash(files):
     return sum(os.path.getsize(f) for f in files if os.path.isfile(f))
 
 
+def file_stats(files):
+    # Returns the (size, mtime) of each of the files, None for missing files
+    stats = []
+    for f in files:
+        try:
+            s = os.stat(f)
+            stats.append((s.st_size, s.st_mtime_ns))
+        except OSError:
+            stats.append(None)
+    return tuple(stats)
+
+
 def exif_size(img):
     # Returns exif-corrected PIL size
     s = img.size  # (width, height)
@@ -63,29 +85,51 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix=''):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', cache_budget=0,
+                      cache_compress=None, shuffle=False, gpu_augment=False, epoch=0):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
+    shards = is_shards(path)
     with torch_distributed_zero_first(rank):
-        dataset = LoadImagesAndLabels(path, imgsz, batch_size,
-                                      augment=augment,  # augment images
-                                      hyp=hyp,  # augmentation hyperparameters
-                                      rect=rect,  # rectangular training
-                                      cache_images=cache,
-                                      single_cls=opt.single_cls,
-                                      stride=int(stride),
-                                      pad=pad,
-                                      image_weights=image_weights,
-                                      prefix=prefix)
+        if shards:  # sequentially read packed shards, see shard_dataset()
+            assert not image_weights, f'{prefix}--image-weights is not supported with shards'
+            dataset = LoadShards(path, imgsz, batch_size, augment=augment, hyp=hyp, single_cls=opt.single_cls,
+                                 stride=int(stride), rank=rank, world_size=world_size, prefix=prefix,
+                                 gpu_augment=gpu_augment)
+        else:
+            dataset = LoadImagesAndLabels(path, imgsz, batch_size,
+                                          augment=augment,  # augment images
+                                          hyp=hyp,  # augmentation hyperparameters
+                                          rect=rect,  # rectangular training
+                                          cache_images=cache,
+                                          single_cls=opt.single_cls,
+                                          stride=int(stride),
+                                          pad=pad,
+                                          image_weights=image_weights,
+                                          prefix=prefix,
+                                          cache_budget=cache_budget,
+                                          cache_compress=cache_compress,
+                                          gpu_augment=gpu_augment)  # resize as augment, see BatchAugment
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
-    loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
+    if dataset.img_lru is not None:
+        dataset.img_lru.budget //= max(nw, 1)  # every worker caches its own images
+    if shards:
+        dataset.set_workers(max(nw, 1))
+    sampler = None
+    if image_weights:  # weights are updated by train.py every epoch
+        sampler = WeightedSampler(np.ones(len(dataset)), len(dataset), rank, world_size)
+    elif rank != -1 and not shards:
+        sampler = torch.utils.data.distributed.DistributedSampler(dataset)
+    if sampler is not None:
+        sampler.set_epoch(epoch)  # first epoch, e.g. of a --resume, _RepeatSampler counts on from it
+    loader = torch.utils.data.DataLoader if shards else InfiniteDataLoader
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
                         batch_size=batch_size,
                         num_workers=nw,
                         sampler=sampler,
+                        shuffle=shuffle and sampler is None and not shards,
                         pin_memory=True,
                         collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
     return dataloader, dataset
@@ -121,12 +165,100 @@ class _RepeatSampler(object):
         self.sampler = sampler
 
     def __iter__(self):
+        sampler = getattr(self.sampler, 'sampler', None)  # of a BatchSampler
+        epoch = getattr(sampler, 'epoch', 0)  # set by create_dataloader()
         while True:
+            if hasattr(sampler, 'set_epoch'):  # each pass is prefetched during the previous one, so set its epoch here
+                sampler.set_epoch(epoch)
             yield from iter(self.sampler)
+            epoch += 1
+
+
+class WeightedSampler(torch.utils.data.Sampler):
+    """ Samples dataset indices with replacement in proportion to per-image weights, e.g. labels_to_image_weights().
+    Indices are drawn in chunks in the main process with the weights current at that time, so set_weights() takes
+    effect on persistent workers within a chunk, also across prefetched epoch boundaries. Under DDP every rank draws its
+    share of len(dataset) indices from its own seed, so only the weights need to agree between ranks.
+    """
+
+    def __init__(self, weights, num_samples, rank=-1, world_size=1, seed=0, chunk=256):
+        self.weights = torch.as_tensor(weights, dtype=torch.float64)
+        self.num_samples = math.ceil(num_samples / world_size)  # per rank
+        self.rank, self.world_size = max(rank, 0), world_size
+        self.seed, self.epoch = seed, 0
+        self.chunk = chunk
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_weights(self, weights):
+        self.weights = torch.as_tensor(weights, dtype=torch.float64)
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch * self.world_size + self.rank)
+        for i in range(0, self.num_samples, self.chunk):
+            yield from torch.multinomial(self.weights, min(self.chunk, self.num_samples - i), True, generator=g).tolist()
+
+
+def stack_batch(imgs):
+    # torch.stack() of uint8 images, in a DataLoader worker directly into shared memory as default_collate does, so the
+    # batch is not copied again to be sent to the main process
+    out = None
+    if torch.utils.data.get_worker_info() is not None:
+        numel = sum(x.numel() for x in imgs)
+        if hasattr(torch.Tensor, '_typed_storage'):  # torch>=2.0
+            storage = imgs[0]._typed_storage()._new_shared(numel, device=imgs[0].device)
+        else:
+            storage = imgs[0].storage()._new_shared(numel)
+        out = imgs[0].new(storage).resize_(len(imgs), *imgs[0].shape)
+    return torch.stack(imgs, 0, out=out)
+
+
+class DevicePrefetcher:
+    """ Iterates (imgs, ...) batches of uint8 images from a DataLoader with imgs on device as float 0.0-1.0. On CUDA
+    batch i + 1 is copied from pinned memory and converted on a side stream while batch i is being processed.
+    """
+
+    def __init__(self, loader, device, half=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dtype = torch.float16 if half else torch.float32
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def load(self, batch):
+        imgs, *rest = batch
+        if self.stream is None:
+            return (imgs.to(self.device).to(self.dtype).div_(255.0), *rest)
+        with torch.cuda.stream(self.stream):
+            imgs = imgs.to(self.device, non_blocking=True).to(self.dtype).div_(255.0)  # 0-255 to 0.0-1.0 on device
+        return (imgs, *rest)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from map(self.load, self.loader)
+            return
+        it = iter(self.loader)
+        batch = next(it, None)
+        batch = batch and self.load(batch)
+        while batch is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_stream(self.stream)  # copy done
+            batch[0].record_stream(stream)  # keep its memory until used on the compute stream
+            following = next(it, None)
+            following = following and self.load(following)  # queued before batch is processed
+            yield batch
+            batch = following
 
 
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, stride=32):
+    def __init__(self, path, img_size=640, stride=32, preprocess=True):
         p = str(Path(path).absolute())  # os-agnostic absolute path
         if '*' in p:
             files = sorted(glob.glob(p, recursive=True))  # glob
@@ -143,6 +275,7 @@ class LoadImages:  # for inference
 
         self.img_size = img_size
         self.stride = stride
+        self.preprocess = preprocess  # letterbox on CPU, else return img=None for letterbox_batch()
         self.files = images + videos
         self.nf = ni + nv  # number of files
         self.video_flag = [False] * ni + [True] * nv
@@ -187,6 +320,9 @@ class LoadImages:  # for inference
             assert img0 is not None, 'Image Not Found ' + path
             #print(f'image {self.count}/{self.nf} {path}: ', end='')
 
+        if not self.preprocess:
+            return path, None, img0, self.cap
+
         # Padded resize
         img = letterbox(img0, self.img_size, stride=self.stride)[0]
 
@@ -264,10 +400,37 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=640, stride=32):
+    """ Stream manager reading many IP/RTSP cameras into preallocated per-stream ring buffers
+
+    Each source is decoded by a daemon thread straight into a ring of `buffer` frame slots, so no frame is allocated
+    after start-up. __next__ letterboxes the selected slot of every stream into one shared uint8 batch array, whose
+    padding is filled once. The returned batch and original frames are only valid until the next iteration.
+
+    Args:
+        frame_stride (int): decode every n-th grabbed frame
+        buffer (int): ring slots per stream, >= 2 so the producer never writes the slot being consumed
+        drop (str): 'latest' serves the newest frame and drops older unread ones, 'fifo' serves frames in order and
+            overwrites the oldest unread frame once the ring is full
+        timeout (float): seconds __next__ waits for a new frame before re-serving the previous one
+        reconnect (float): max seconds between reconnection attempts of a dropped live stream, video files end
+            iteration once their last frame is served
+        preprocess (bool): letterbox on CPU, else return img=None for letterbox_batch()
+    """
+
+    def __init__(self, sources='streams.txt', img_size=640, stride=32, frame_stride=4, buffer=3, drop='latest',
+                 timeout=1.0, reconnect=30.0, preprocess=True):
+        assert buffer >= 2, f'stream buffer={buffer} must be >= 2'
+        assert drop in ('latest', 'fifo'), f"invalid drop policy '{drop}', valid policies are 'latest', 'fifo'"
         self.mode = 'stream'
         self.img_size = img_size
         self.stride = stride
+        self.frame_stride = max(int(frame_stride), 1)
+        self.buffer = buffer
+        self.drop = drop
+        self.timeout = timeout
+        self.reconnect = reconnect
+        self.preprocess = preprocess
+        self.running = True
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -276,8 +439,14 @@ class LoadStreams:  # multiple IP or RTSP cameras
             sources = [sources]
 
         n = len(sources)
-        self.imgs = [None] * n
         self.sources = [clean_str(x) for x in sources]  # clean source names for later
+        self.urls, self.fps, self.files = [None] * n, [0.0] * n, [False] * n
+        self.frames = [None] * n  # ring buffers (buffer, h, w, 3)
+        self.seq = [None] * n  # frame sequence number per slot, -1 if empty
+        self.held = [0] * n  # slot handed out by the last __next__, never written by the producer
+        self.ended = [False] * n  # video file read to its end
+        self.last = [-1] * n  # sequence number of the last served frame
+        self.cond = [Condition() for _ in range(n)]
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
             print(f'{i + 1}/{n}: {s}... ', end='')
@@ -290,32 +459,81 @@ class LoadStreams:  # multiple IP or RTSP cameras
             assert cap.isOpened(), f'Failed to open {s}'
             w = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            self.fps = cap.get(cv2.CAP_PROP_FPS) % 100
-
-            _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.urls[i], self.fps[i] = url, cap.get(cv2.CAP_PROP_FPS) % 100
+            self.files[i] = isinstance(url, str) and os.path.isfile(url)  # video file, read as fast as it decodes
+
+            success, im = cap.read()  # guarantee first frame
+            assert success, f'Failed to read {s}'
+            self.frames[i] = np.empty((buffer, *im.shape), dtype=np.uint8)
+            self.frames[i][0] = im
+            self.seq[i] = np.full(buffer, -1, dtype=np.int64)
+            self.seq[i][0] = 0
             thread = Thread(target=self.update, args=([i, cap]), daemon=True)
-            print(f' success ({w}x{h} at {self.fps:.2f} FPS).')
+            print(f' success ({w}x{h} at {self.fps[i]:.2f} FPS).')
             thread.start()
         print('')  # newline
 
         # check for common shapes
-        s = np.stack([letterbox(x, self.img_size, stride=self.stride)[0].shape for x in self.imgs], 0)  # shapes
+        s = np.stack([self.letterbox_shape(x.shape[1:3]) for x in self.frames], 0)  # shapes
         self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
         if not self.rect:
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
+        # Shared letterboxed batch, borders are written once and only the image regions are refreshed
+        h, w = s[0] if self.rect else (img_size, img_size)
+        self.imgs = np.full((n, 3, h, w), 114, dtype=np.uint8)
+        self.geometry = [None] * n  # (frame shape, resize buffer, top, left) per stream
+
+    def letterbox_shape(self, shape):
+        # Returns the auto-letterboxed (h, w) of a frame of shape (h, w)
+        _, (w, h), _, (top, bottom, left, right) = letterbox_params(shape, self.img_size, stride=self.stride)
+        return h + top + bottom, w + left + right
+
     def update(self, index, cap):
-        # Read next stream frame in a daemon thread
-        n = 0
-        while cap.isOpened():
+        # Read next stream frame in a daemon thread, reconnecting with exponential backoff if a live stream drops
+        n, fails, cond = 0, 0, self.cond[index]
+        while self.running:
+            t = time.time()
+            if not (cap.isOpened() and cap.grab()):
+                if self.files[index]:  # end of the video file
+                    with cond:
+                        self.ended[index] = True
+                        cond.notify()
+                    break
+                cap.release()
+                time.sleep(min(2 ** fails, self.reconnect))
+                fails += 1
+                print(f'WARNING: stream {self.sources[index]} unresponsive, reconnecting (attempt {fails})...')
+                cap = cv2.VideoCapture(self.urls[index])
+                continue
+            fails = 0
             n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                success, im = cap.retrieve()
-                self.imgs[index] = im if success else self.imgs[index] * 0
-                n = 0
-            time.sleep(1 / self.fps)  # wait time
+            if n % self.frame_stride == 0:  # decode every frame_stride-th frame
+                with cond:  # next slot in ring order, skipping the consumed one
+                    seq = self.seq[index]
+                    slot = (int(seq.argmax()) + 1) % self.buffer
+                    if slot == self.held[index]:
+                        slot = (slot + 1) % self.buffer
+                    seq[slot] = -1  # invalidate while writing
+                ring = self.frames[index]
+                dst = ring[slot]
+                success, im = cap.retrieve(dst)  # decode in place
+                if success and im is not dst:  # decoder did not write into the slot
+                    with cond:
+                        if im.shape != ring.shape[1:]:  # resolution changed, re-allocate this ring
+                            held = self.held[index]
+                            ring = np.empty((self.buffer, *im.shape), dtype=np.uint8)
+                            ring[held] = cv2.resize(self.frames[index][held], im.shape[1::-1])
+                            seq[np.arange(self.buffer) != held] = -1
+                            self.frames[index] = ring
+                        ring[slot] = im
+                if success:
+                    with cond:
+                        seq[slot] = seq.max() + 1
+                        cond.notify()
+            if self.files[index] and self.fps[index]:  # live streams block in grab() until the next frame
+                time.sleep(max(1 / self.fps[index] - (time.time() - t), 0))  # pace files to their fps net of decode
+        cap.release()
 
     def __iter__(self):
         self.count = -1
@@ -323,22 +541,47 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
         if cv2.waitKey(1) == ord('q'):  # q to quit
+            self.running = False
             cv2.destroyAllWindows()
             raise StopIteration
 
-        # Letterbox
-        img = [letterbox(x, self.img_size, auto=self.rect, stride=self.stride)[0] for x in img0]
-
-        # Stack
-        img = np.stack(img, 0)
+        img0 = []
+        for i, cond in enumerate(self.cond):
+            with cond:
+                if not cond.wait_for(lambda: self.seq[i].max() > self.last[i] or self.ended[i], timeout=self.timeout):
+                    print(f'WARNING: no new frame from {self.sources[i]} in {self.timeout}s, re-using last frame')
+                seq = self.seq[i]
+                if self.ended[i] and seq.max() <= self.last[i]:  # every frame of the video file served
+                    self.running = False
+                    raise StopIteration
+                if seq.max() > self.last[i]:
+                    fresh = np.where(seq > self.last[i], seq, np.iinfo(seq.dtype).max)
+                    slot = int(seq.argmax()) if self.drop == 'latest' else int(fresh.argmin())
+                    self.held[i], self.last[i] = slot, int(seq[slot])
+                im = self.frames[i][self.held[i]]
+            img0.append(im)
+            if not self.preprocess:
+                continue
 
-        # Convert
-        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to bsx3x416x416
-        img = np.ascontiguousarray(img)
+            # Letterbox directly into the shared batch
+            g = self.geometry[i]
+            if g is None or g[0] != im.shape:
+                auto = self.rect and self.letterbox_shape(im.shape[:2]) == self.imgs.shape[2:]
+                _, (w, h), _, (top, bottom, left, right) = letterbox_params(im.shape[:2],
+                                                                            self.img_size if auto else self.imgs.shape[2:],
+                                                                            auto=auto, stride=self.stride)
+                self.imgs[i] = 114
+                g = self.geometry[i] = im.shape, np.empty((h, w, 3), dtype=np.uint8), top, left
+            _, resized, top, left = g
+            h, w = resized.shape[:2]
+            if im.shape[:2] != (h, w):
+                cv2.resize(im, (w, h), dst=resized, interpolation=cv2.INTER_LINEAR)
+            else:
+                resized = im
+            self.imgs[i, :, top:top + h, left:left + w] = resized[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, HWC to CHW
 
-        return self.sources, img, img0, None
+        return self.sources, self.imgs if self.preprocess else None, img0, None
 
     def __len__(self):
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
@@ -350,11 +593,420 @@ def img2label_paths(img_paths):
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+def verify_image_label(args):
+    # Verify one image-label pair, returns (im_file, labels, shape, segments, missing, found, empty, corrupt, message)
+    im_file, lb_file = args
+    nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, corrupt
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            nf = 1  # label found
+            with open(lb_file, 'r') as f:
+                l = [x.split() for x in f.read().strip().splitlines()]
+                if any([len(x) > 8 for x in l]):  # is segment
+                    classes = np.array([x[0] for x in l], dtype=np.float32)
+                    segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+                    l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+                l = np.array(l, dtype=np.float32)
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                ne = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            nm = 1  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, nm, nf, ne, nc, ''
+    except Exception as e:
+        nc = 1
+        return None, None, None, None, nm, nf, ne, nc, f'WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
+class LabelStore:
+    """
+    Columnar label cache, one row per scanned image in dataset order: file names, (size, mtime) stats, counts and
+    shapes, all labels concatenated into one (N, 5) array with per-image offsets, and all segment points in one (P, 2)
+    blob with per-segment and per-image offsets. Saved as raw arrays behind a JSON header and memory-mapped read-only,
+    so loading is zero-copy and DataLoader workers share the pages instead of holding millions of small arrays.
+    """
+    version = 0.3
+    magic = b'YOLOLBL\0'
+    align = 64  # array alignment in the file
+
+    def __init__(self, arrays, meta=None, path=None):
+        self.arrays = arrays  # name -> ndarray or read-only np.memmap
+        self.meta = meta or {}  # version, hash, results
+        self.path = path  # file the arrays are mapped from
+        self.single_cls = False
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['arrays'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __len__(self):
+        return len(self.arrays['shapes'])
+
+    def __getstate__(self):  # re-map rather than copy the arrays when sent to spawned DataLoader workers
+        return self.__dict__ if self.path is None else {**self.__dict__, 'arrays': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.arrays is None:
+            self.arrays = type(self).load(self.path).arrays
+            if self.single_cls:
+                self.set_single_cls()
+
+    @property
+    def results(self):
+        return tuple(self.meta['results'])
+
+    def set_single_cls(self):
+        # Replace the mapped labels by an in-memory copy with all classes set to 0
+        self.arrays['labels'] = np.array(self.arrays['labels'])
+        self.arrays['labels'][:, 0] = 0
+        self.single_cls = True
+
+    @classmethod
+    def from_entries(cls, files, stats, counts, entries, **meta):
+        # Build from per-image (labels, shape, segments) entries, None for corrupt images
+        n = len(files)
+        shapes, labels, segments = np.zeros((n, 2), dtype=np.int64), [], []
+        label_offsets, segment_index = np.zeros(n + 1, dtype=np.int64), np.zeros(n + 1, dtype=np.int64)
+        for i, entry in enumerate(entries):
+            l, shape, segs = entry or (np.zeros((0, 5), dtype=np.float32), (0, 0), [])
+            shapes[i] = shape
+            labels.append(l)
+            segments.extend(segs)
+            label_offsets[i + 1] = label_offsets[i] + len(l)
+            segment_index[i + 1] = segment_index[i] + len(segs)
+        segment_offsets = np.cumsum([0] + [len(x) for x in segments], dtype=np.int64)
+        arrays = {'files': np.array([f.encode() for f in files], dtype=bytes),
+                  'stats': np.asarray(stats, dtype=np.int64).reshape(n, 4),
+                  'counts': np.asarray(counts, dtype=np.uint8).reshape(n, 4),
+                  'shapes': shapes,
+                  'labels': np.concatenate(labels, 0).astype(np.float32, copy=False) if n else np.zeros((0, 5), np.float32),
+                  'label_offsets': label_offsets,
+                  'points': np.concatenate(segments, 0).astype(np.float32, copy=False) if segments else
+                  np.zeros((0, 2), np.float32),
+                  'segment_offsets': segment_offsets,
+                  'segment_index': segment_index}
+        return cls(arrays, {'version': cls.version, **meta})
+
+    def entry(self, i):
+        # Returns the (labels, shape, segments) of image i
+        segments = [self.points[self.segment_offsets[k]:self.segment_offsets[k + 1]]
+                    for k in range(self.segment_index[i], self.segment_index[i + 1])]
+        return self.labels[self.label_offsets[i]:self.label_offsets[i + 1]], tuple(self.shapes[i]), segments
+
+    def save(self, path):
+        # Write the header and the arrays to a temporary file, then atomically replace path
+        header, offset = {**self.meta, 'arrays': {}}, 0
+        for name, x in self.arrays.items():
+            header['arrays'][name] = {'dtype': x.dtype.str, 'shape': x.shape, 'offset': offset}
+            offset += -(-x.nbytes // self.align) * self.align
+        h = json.dumps(header).encode()
+        start = -(-(len(self.magic) + 8 + len(h)) // self.align) * self.align
+        tmp = Path(path).with_suffix(Path(path).suffix + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(self.magic + len(h).to_bytes(8, 'little') + h)
+            for name, x in self.arrays.items():
+                f.seek(start + header['arrays'][name]['offset'])
+                f.write(np.ascontiguousarray(x).data)  # mapped arrays are streamed, not copied
+            f.truncate(start + offset)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        # Memory-map a saved store, raises if the file is not a store of this version
+        with open(path, 'rb') as f:
+            assert f.read(len(cls.magic)) == cls.magic, 'not a label store'
+            n = int.from_bytes(f.read(8), 'little')
+            header = json.loads(f.read(n))
+        assert header['version'] == cls.version, f"label store version {header['version']} != {cls.version}"
+        start = -(-(len(cls.magic) + 8 + n) // cls.align) * cls.align
+        arrays = {}
+        for name, a in header.pop('arrays').items():
+            dtype, shape = np.dtype(a['dtype']), tuple(a['shape'])
+            arrays[name] = np.memmap(path, dtype, 'r', start + a['offset'], shape) if np.prod(shape) else \
+                np.zeros(shape, dtype)  # empty arrays can not be mapped
+        return cls(arrays, header, path)
+
+
+class CropBank(LabelStore):
+    """
+    Segmented object crops extracted once by crop_bank(), for paste-in: per-crop class and (h, w), the BGR pixels and
+    the polygon masks of all crops concatenated into two blobs with per-crop offsets, and the crops grouped by class.
+    Saved and memory-mapped as a LabelStore, so drawing paste-in samples is a few slices instead of extra mosaics.
+    """
+    version = 0.1
+    magic = b'YOLOCRP\0'
+
+    def __len__(self):
+        return len(self.arrays['classes'])
+
+    def set_single_cls(self):
+        self.arrays['classes'] = np.zeros_like(self.arrays['classes'])
+        self.single_cls = True
+
+    def crop(self, i):
+        # Returns the (class, image, mask) of crop i, image and mask are views into the bank
+        (h, w), o = self.shapes[i], self.offsets
+        return float(self.classes[i]), self.pixels[o[i]:o[i + 1]].reshape(h, w, 3), self.masks[o[i]:o[i + 1]].reshape(h, w)
+
+    def sample(self, n, balanced=False):
+        # Returns the classes, images and masks of n random crops, of uniformly drawn classes if balanced
+        if not len(self):
+            return [], [], []
+        if balanced:
+            o = self.class_offsets
+            c = np.flatnonzero(o[1:] > o[:-1]).tolist()  # classes with crops
+            k = [self.class_index[random.randrange(o[j], o[j + 1])] for j in random.choices(c, k=n)]
+        else:
+            k = random.choices(range(len(self)), k=n)
+        return tuple(map(list, zip(*(self.crop(i) for i in k))))
+
+    @classmethod
+    def open(cls, path, labels, img_size, prefix=''):
+        # Returns the bank at path if it was extracted from the LabelStore `labels` at img_size, else None
+        if not Path(path).is_file():
+            return None
+        try:
+            bank = cls.load(path)
+        except Exception as e:
+            logger.info(f'{prefix}WARNING: Ignoring crop bank {path}: {e}')
+            return None
+        if bank.meta['hash'] != labels.meta.get('hash') or bank.meta['img_size'] != img_size:
+            logger.info(f'{prefix}WARNING: Ignoring outdated crop bank {path}, rebuild it with crop_bank()')
+            return None
+        if labels.single_cls:
+            bank.set_single_cls()
+        logger.info(f'{prefix}Paste-in from {len(bank)} crops in {path}')
+        return bank
+
+
+class LabelView:
+    # Read-only sequence of per-image slices of a LabelStore array, e.g. labels[i] or segments[i], for a subset of images
+    def __init__(self, store, name, offsets, indices, inner=None):
+        self.store = store
+        self.name = name  # data array
+        self.offsets = offsets  # per-image offsets array (or per-segment offsets if inner)
+        self.inner = inner  # per-image segment index array for nested (list of arrays) items
+        self.indices = np.asarray(indices, dtype=np.int64)  # image in the store of each item
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if not isinstance(i, (int, np.integer)):  # index array, e.g. rect sorting
+            return LabelView(self.store, self.name, self.offsets, self.indices[i], self.inner)
+        j, x, o = self.indices[i], getattr(self.store, self.name), getattr(self.store, self.offsets)
+        if self.inner is None:
+            return x[o[j]:o[j + 1]]
+        k = getattr(self.store, self.inner)
+        return [x[o[m]:o[m + 1]] for m in range(k[j], k[j + 1])]
+
+    def flat(self, i):
+        # Returns nested item i as one concatenated array and the (n+1) offsets of its n sub-arrays, without copies
+        j, x, o, k = self.indices[i], getattr(self.store, self.name), getattr(self.store, self.offsets), \
+                     getattr(self.store, self.inner)
+        o = o[k[j]:k[j + 1] + 1]
+        return x[o[0]:o[-1]], o - o[0]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class ImageCache:
+    """
+    Resized dataset images in one memory-mapped arena file, filled once and shared by all DDP ranks and DataLoader
+    workers on a node. The file holds a JSON header, a filled flag per image and the pixels at fixed offsets derived
+    from the image shapes. It lives in shared memory (/dev/shm) for 'ram' caching or beside the label cache for 'disk'.
+    Images not in the arena return None and are decoded by load_image. A shared memory arena is removed by the process
+    that created it when it exits or is terminated, and by the next run if that process was killed.
+    """
+    magic = b'YOLOIMG\0'
+    version = 0.1
+    align = 4096  # page aligned pixels
+
+    def __init__(self, path, hw0, hw, meta):
+        self.path = Path(path)
+        self.hw0, self.hw = hw0, hw  # (n, 2) original and resized shapes
+        self.meta = {'version': self.version, **meta}
+        sizes = -(-hw[:, 0].astype(np.int64) * hw[:, 1] * 3 // 64) * 64
+        self.offsets = np.concatenate(([0], np.cumsum(sizes)))
+        self.header = -(-(len(self.magic) + 8 + len(json.dumps(self.meta)) + len(hw)) // self.align) * self.align
+        self.size = self.header + int(self.offsets[-1])
+        self.mm = None
+
+    def __len__(self):
+        return len(self.hw)
+
+    def __getitem__(self, i):
+        if not self.filled[i]:
+            return None
+        (h, w), o = self.hw[i], self.header + self.offsets[i]
+        return self.mm[o:o + h * w * 3].reshape(h, w, 3)
+
+    def __getstate__(self):  # re-map rather than copy the arena when sent to spawned DataLoader workers
+        return {**self.__dict__, 'mm': None, 'filled': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open(mode='r')
+
+    def open(self, mode='r+'):
+        # Map an existing arena file, returns False if it is missing or was written for another dataset
+        try:
+            with open(self.path, 'rb') as f:
+                assert f.read(len(self.magic)) == self.magic
+                meta = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+            assert meta == self.meta and self.path.stat().st_size == self.size
+        except Exception:
+            return False
+        self.mm = np.memmap(self.path, np.uint8, mode, 0, self.size)
+        self.filled = self.mm[self.header - len(self):self.header]
+        return True
+
+    def create(self):
+        # Create and map an empty arena, space is reserved up front so a full device fails here and not on a write
+        h = json.dumps(self.meta).encode()
+        with open(self.path, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, self.size)
+            else:
+                f.truncate(self.size)
+            f.write(self.magic + len(h).to_bytes(8, 'little') + h)
+            f.seek(self.header - len(self))
+            f.write(bytes(len(self)))  # filled flags
+        assert self.open(), f'failed to map {self.path}'
+
+    def own(self):
+        # Remove the arena when this process exits or is terminated, recording its pid for remove_stale()
+        pid = os.getpid()
+        self.path.with_suffix('.pid').write_text(str(pid))
+
+        def release(*args):
+            if os.getpid() == pid:  # not in forked DataLoader workers
+                for f in self.path, self.path.with_suffix('.pid'):
+                    f.unlink(missing_ok=True)
+
+        def terminate(signum, frame, handler):
+            release()
+            handler(signum, frame) if callable(handler) else os._exit(128 + signum)  # then as before
+
+        atexit.register(release)
+        if current_thread() is main_thread():  # signal handlers can only be set from the main thread
+            for sig in [getattr(signal, x) for x in ('SIGTERM', 'SIGHUP') if hasattr(signal, x)]:
+                handler = signal.getsignal(sig)
+                if handler is not signal.SIG_IGN:
+                    signal.signal(sig, lambda signum, frame, handler=handler: terminate(signum, frame, handler))
+
+    @staticmethod
+    def remove_stale(directory):
+        # Remove arenas of processes that died without releasing them, see own()
+        for f in Path(directory).glob('yolov7_*.pid'):
+            try:
+                os.kill(int(f.read_text()), 0)
+            except ProcessLookupError:  # owner gone
+                f.with_suffix('.imgcache').unlink(missing_ok=True)
+                f.unlink(missing_ok=True)
+            except (OSError, ValueError):  # owned by another user, or being written
+                pass
+
+    def fill(self, dataset, prefix=''):
+        # Decode and resize the missing images into the arena with load_image
+        todo = np.flatnonzero(~self.filled.astype(bool))
+        gb, skipped = int(self.offsets[-1]) / 1E9, 0
+        results = ThreadPool(8).imap(lambda i: (i, *load_image(dataset, i)), todo)
+        pbar = tqdm(results, total=len(todo), desc=f'{prefix}Caching images ({gb:.1f}GB) in {self.path}')
+        for i, img, _, hw in pbar:
+            if hw != tuple(self.hw[i]):  # shape differs from the label cache, e.g. EXIF orientation, decode on use
+                skipped += 1
+                continue
+            o = self.header + self.offsets[i]
+            self.mm[o:o + img.size] = img.reshape(-1)
+            self.filled[i] = 1
+        pbar.close()
+        self.mm.flush()
+        if skipped:
+            logger.info(f'{prefix}WARNING: {skipped} images not cached, decoded shape differs from the label cache')
+
+
+class ImageLRU:
+    """
+    Byte-budgeted least recently used cache of resized images for load_image, for datasets that do not fit in RAM.
+    Each process (main or DataLoader worker) keeps its own items within `budget` bytes, optionally as PNG (lossless) or
+    JPEG bytes to fit more images. Hits, misses, evictions and bytes used are counted per process in shared memory so
+    the main process can report them.
+    """
+    quality = {'png': [cv2.IMWRITE_PNG_COMPRESSION, 1], 'jpg': [cv2.IMWRITE_JPEG_QUALITY, 95]}
+
+    def __init__(self, budget, compress=None):
+        assert compress in (None, 'png', 'jpg'), f'invalid image cache compression {compress}'
+        self.budget = int(budget)  # bytes per process
+        self.compress = compress
+        self.items = OrderedDict()  # index -> (image or encoded bytes, hw_original, hw_resized), oldest first
+        self.bytes = 0
+        self.stats = torch.zeros((os.cpu_count() + 1, 4), dtype=torch.int64).share_memory_()  # hits, misses, evictions, bytes
+        self.last = torch.zeros(4, dtype=torch.int64)  # totals at the last report
+
+    def slot(self):
+        # Stats row of this process, 0 for the main process
+        info = torch.utils.data.get_worker_info()
+        return 0 if info is None else info.id + 1
+
+    def get(self, index):
+        stats = self.stats[self.slot()]
+        x = self.items.get(index)
+        if x is None:
+            stats[1] += 1
+            return None
+        self.items.move_to_end(index)
+        stats[0] += 1
+        im, hw0, hw = x
+        return cv2.imdecode(im, cv2.IMREAD_COLOR) if self.compress else im, hw0, hw
+
+    def put(self, index, img, hw0, hw):
+        im = cv2.imencode(f'.{self.compress}', img, self.quality[self.compress])[1] if self.compress else img
+        if im.nbytes > self.budget:
+            return
+        stats = self.stats[self.slot()]
+        self.items[index] = im, hw0, hw
+        self.bytes += im.nbytes
+        while self.bytes > self.budget:  # evict least recently used
+            self.bytes -= self.items.popitem(last=False)[1][0].nbytes
+            stats[2] += 1
+        stats[3] = self.bytes
+
+    def report(self):
+        # Hit rate and evictions since the last report and bytes used now, summed over processes
+        total = self.stats.sum(0)
+        hits, misses, evictions, _ = (total - self.last).tolist()
+        self.last = total
+        return f'Image cache: {hits / max(hits + misses, 1):.1%} hit rate, {evictions} evictions, ' \
+               f'{total[3] / 1E9:.2f}GB used'
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', cache_budget=0, cache_compress=None,
+                 gpu_augment=False):
         self.img_size = img_size
         self.augment = augment
+        self.scaleup = augment or gpu_augment  # training resize, INTER_LINEAR and letterbox scaleup
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
@@ -388,31 +1040,30 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
-        if cache_path.is_file():
-            cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
-        else:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+        try:
+            cache, exists = LabelStore.load(cache_path), True  # memory-map
+        except Exception:
+            cache, exists = None, False  # missing, unreadable or outdated
+        cache = self.cache_labels(cache_path, prefix, cache)  # re-verify new and modified files
 
         # Display cache
-        nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
+        nf, nm, ne, nc, n = cache.results  # found, missing, empty, corrupted, total
         if exists:
             d = f"Scanning '{cache_path}' images and labels... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
             tqdm(None, desc=prefix + d, total=n, initial=n)  # display cache results
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
-        # Read cache
-        cache.pop('hash')  # remove hash
-        cache.pop('version')  # remove version
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
-        self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        # Read cache, labels and segments are views into the store
         if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+            cache.set_single_cls()
+        i = np.flatnonzero(cache.counts[:, 3] == 0)  # not corrupted
+        self.labels = LabelView(cache, 'labels', 'label_offsets', i)
+        self.segments = LabelView(cache, 'points', 'segment_offsets', i, inner='segment_index')
+        shapes = cache.shapes[i]
+        self.shapes = np.array(shapes, dtype=np.float64)
+        self.img_files = [self.img_files[j] for j in i]  # update
+        self.label_files = img2label_paths(self.img_files)  # update
+        self.img_resized = resized_files(self.img_files, img_size, cache.stats[i, 1])  # resize_dataset() copies
 
         n = len(shapes)  # number of images
         bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
@@ -429,7 +1080,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             irect = ar.argsort()
             self.img_files = [self.img_files[i] for i in irect]
             self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.img_resized = [self.img_resized[i] for i in irect]
+            self.labels = self.labels[irect]
+            self.segments = self.segments[irect]
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
@@ -445,81 +1098,104 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
-        # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
+        # Cache images into a shared arena for faster training (WARNING: large datasets may exceed system RAM)
         self.imgs = [None] * n
+        self.img_lru = ImageLRU(cache_budget * 1E9, cache_compress) if cache_budget and not cache_images else None
         if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
-            gb = 0  # Gigabytes of cached images
-            self.img_hw0, self.img_hw = [None] * n, [None] * n
-            results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
-            pbar = tqdm(enumerate(results), total=n)
-            for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
-                    gb += self.imgs[i].nbytes
-                pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
-            pbar.close()
-
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
+            self.imgs = self.cache_images(cache_path, 'disk' if cache_images == 'disk' else 'ram', prefix)
+            self.img_hw0, self.img_hw = self.imgs.hw0, self.imgs.hw
+
+        # Paste-in objects from a crop bank if one was extracted for these labels, see crop_bank()
+        self.crop_bank = None
+        if augment and hyp and hyp.get('paste_in'):
+            self.crop_bank = CropBank.open(cache_path.with_suffix('.crops'), cache, img_size, prefix)
+
+    def cache_images(self, path, mode='ram', prefix=''):
+        # Returns the ImageCache of this dataset, filling it unless a previous run or another DDP rank already has
+        hw0 = self.shapes[:, ::-1].astype(np.int64)  # original hw
+        r = self.img_size / hw0.max(1, keepdims=True)
+        hw = np.where(r != 1, (hw0 * r).astype(np.int64), hw0)  # resized hw, as load_image
+        meta = {'files': zlib.crc32('\n'.join(self.img_files).encode()), 'img_size': self.img_size,
+                'augment': self.scaleup}  # resize interpolation depends on augment
+        key = f"{path.stem}_{zlib.crc32(json.dumps(meta).encode()):08x}.imgcache"
+        shm = Path('/dev/shm')
+        if mode == 'ram' and not shm.is_dir():
+            logger.info(f'{prefix}WARNING: no shared memory at {shm}, caching images on disk')
+            mode = 'disk'
+        if mode == 'ram':
+            ImageCache.remove_stale(shm)
+        cache = ImageCache(shm / f'yolov7_{key}' if mode == 'ram' else path.with_name(key), hw0, hw, meta)
+        if not cache.open():
+            if mode == 'ram' and shutil.disk_usage(shm).free < cache.size:
+                logger.info(f'{prefix}WARNING: {cache.size / 1E9:.1f}GB image cache exceeds free shared memory, '
+                            f'caching images on disk')
+                cache = ImageCache(path.with_name(key), hw0, hw, meta)
+                if cache.open():
+                    return cache
+            if cache.path.parent == shm:
+                cache.own()  # release the shared memory with this process
+            cache.create()
+        if not cache.filled.all():
+            cache.fill(self, prefix)
+        return cache
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', cache=None):
+        # Cache dataset labels, check images and read shapes into a LabelStore. Entries of `cache` are reused for files
+        # whose image and label (size, mtime) are unchanged, new and modified files are re-verified and deleted dropped
+        n = len(self.img_files)
+        with ThreadPool(num_threads) as pool:
+            stats = pool.map(file_stats, zip(self.img_files, self.label_files), chunksize=max(1, min(256, n // 64)))
+        stats = np.array([[v for st in x for v in (st or (-1, -1))] for x in stats], dtype=np.int64).reshape(n, 4)
+        old = {f.decode(): i for i, f in enumerate(cache.files)} if cache is not None else {}
+        old_i = np.array([old.get(f, -1) for f in self.img_files], dtype=np.int64)
+        todo = np.flatnonzero((old_i < 0) | (cache.stats[old_i] != stats).any(1) if old else np.ones(n, dtype=bool))
+        if not len(todo) and len(old) == n and (old_i == np.arange(n)).all():
+            return cache  # up to date
+
+        # Verify new and modified files, none if files were only deleted or reordered
+        results = {}
         nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
-            try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
-            except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+        chunksize = max(1, min(64, len(todo) // (num_threads * 4)))  # amortize IPC, keep the progress bar moving
+        desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels..."
+        if old:
+            desc += f" {len(todo)} new or modified:"
+        files = ((self.img_files[i], self.label_files[i]) for i in todo)
+        with Pool(num_threads) if len(todo) >= 100 else nullcontext() as pool:  # few files verify faster inline
+            pbar = tqdm(pool.imap(verify_image_label, files, chunksize=chunksize) if pool else
+                        map(verify_image_label, files), desc=desc, total=len(todo))
+            for j, (im_file, l, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in enumerate(pbar):  # in dataset order
+                nm += nm_f
+                nf += nf_f
+                ne += ne_f
+                nc += nc_f
+                results[todo[j]] = [l, shape, segments] if im_file else None, (nm_f, nf_f, ne_f, nc_f)
+                if msg:
+                    print(f'{prefix}{msg}')
+                pbar.desc = f"{desc} {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+            pbar.close()
 
+        # Merge with the unchanged entries, in dataset order
+        entries, counts = [], np.zeros((n, 4), dtype=np.uint8)  # missing, found, empty, corrupt
+        for i in range(n):
+            if i in results:
+                entry, counts[i] = results[i]
+            else:
+                counts[i] = cache.counts[old_i[i]]
+                entry = cache.entry(old_i[i]) if not counts[i, 3] else None
+            entries.append(entry)
+        nm, nf, ne, nc = counts.sum(0).tolist()
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
 
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
-        torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
+        x = LabelStore.from_entries(self.img_files, stats, counts, entries,
+                                    hash=int(np.where(stats[:, ::2] > 0, stats[:, ::2], 0).sum()),  # as get_hash()
+                                    results=(nf, nm, ne, nc, n))
+        try:  # save for next time, atomically so an interrupted write never leaves a truncated cache
+            x.save(path)
+            x = LabelStore.load(path)
+            logging.info(f'{prefix}New cache created: {path}')
+        except Exception as e:
+            logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # not writeable
         return x
 
     def __len__(self):
@@ -547,9 +1223,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             # MixUp https://arxiv.org/pdf/1710.09412.pdf
             if random.random() < hyp['mixup']:
                 if random.random() < 0.8:
-                    img2, labels2 = load_mosaic(self, random.randint(0, len(self.labels) - 1))
+                    img2, labels2 = load_mosaic(self, self.random_index())
                 else:
-                    img2, labels2 = load_mosaic9(self, random.randint(0, len(self.labels) - 1))
+                    img2, labels2 = load_mosaic9(self, self.random_index())
                 r = np.random.beta(8.0, 8.0)  # mixup ratio, alpha=beta=8.0
                 img = (img * r + img2 * (1 - r)).astype(np.uint8)
                 labels = np.concatenate((labels, labels2), 0)
@@ -560,7 +1236,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
             # Letterbox
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
-            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
+            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.scaleup)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
             labels = self.labels[index].copy()
@@ -589,8 +1265,10 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             
             if random.random() < hyp['paste_in']:
                 sample_labels, sample_images, sample_masks = [], [], [] 
+                if self.crop_bank is not None:
+                    sample_labels, sample_images, sample_masks = self.crop_bank.sample(30, hyp.get('paste_in_balanced'))
                 while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, self.random_index())
                     sample_labels += sample_labels_
                     sample_images += sample_images_
                     sample_masks += sample_masks_
@@ -628,12 +1306,16 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
 
         return torch.from_numpy(img), labels_out, self.img_files[index], shapes
 
+    def random_index(self):
+        # Index of a random image for mixup and paste-in
+        return random.randint(0, len(self.labels) - 1)
+
     @staticmethod
     def collate_fn(batch):
         img, label, path, shapes = zip(*batch)  # transposed
         for i, l in enumerate(label):
             l[:, 0] = i  # add target image index for build_targets()
-        return torch.stack(img, 0), torch.cat(label, 0), path, shapes
+        return stack_batch(img), torch.cat(label, 0), path, shapes
 
     @staticmethod
     def collate_fn4(batch):
@@ -659,7 +1341,118 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         for i, l in enumerate(label4):
             l[:, 0] = i  # add target image index for build_targets()
 
-        return torch.stack(img4, 0), torch.cat(label4, 0), path4, shapes4
+        return stack_batch(img4), torch.cat(label4, 0), path4, shapes4
+
+
+class LoadShards(LoadImagesAndLabels, IterableDataset):
+    """
+    Sequentially read training dataset of packed tar shards written by shard_dataset(). DataLoader workers and DDP ranks
+    stream disjoint shards in an epoch-seeded order, and samples are drawn at random from a buffer of `shuffle_buffer`
+    encoded images, which also supplies the extra images of mosaic, mixup and paste-in. In training every rank yields the
+    same number of whole batches, workers whose shards run short continue with the shards of the others. For evaluation
+    every sample of a rank's shards is yielded once in order, the last batch partial. Labels and shapes come from the
+    shard index, so dataset.labels and dataset.shapes work as for LoadImagesAndLabels.
+    """
+
+    def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, single_cls=False, stride=32,
+                 shuffle_buffer=1000, rank=-1, world_size=1, seed=0, prefix='', gpu_augment=False):
+        self.img_size = img_size
+        self.augment = augment
+        self.scaleup = augment or gpu_augment  # training resize, INTER_LINEAR and letterbox scaleup
+        self.training = augment or gpu_augment  # shuffled whole batches, else every sample once for evaluation
+        self.hyp = hyp
+        self.image_weights = False
+        self.rect = False
+        self.mosaic = self.augment  # load 4 images at a time into a mosaic (only during training)
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.stride = stride
+        self.path = path
+
+        cache = LabelStore.load(Path(path) / 'index.cache')
+        nf, nm, ne, nc, n = cache.results
+        d = f"Scanning '{path}' shards... {nf} found, {nm} missing, {ne} empty, {nc} corrupted"
+        tqdm(None, desc=prefix + d, total=n, initial=n)  # display index results
+        assert nf > 0 or not augment, f'{prefix}No labels in {path}. Can not train without labels. See {help_url}'
+        if single_cls:
+            cache.set_single_cls()
+        i = np.arange(n)
+        self.labels = LabelView(cache, 'labels', 'label_offsets', i)
+        self.segments = LabelView(cache, 'points', 'segment_offsets', i, inner='segment_index')
+        self.shapes = cache.shapes.astype(np.float64)
+        self.img_files = [f.decode() for f in cache.files]  # original image files, for reference
+        self.label_files = img2label_paths(self.img_files)
+        self.shards = [str(Path(path) / f) for f in cache.meta['shards']]
+        self.batch = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
+        self.n = n
+        self.imgs, self.img_resized, self.img_lru = [None] * n, None, None
+        self.img_buffer, self.indices = {}, []  # index -> encoded image, buffered indices
+        self.crop_bank = None
+        self.shuffle_buffer = shuffle_buffer if self.training else 1
+        self.rank, self.world_size = (rank, world_size) if rank != -1 else (0, 1)
+        self.seed, self.epoch = seed, 0
+        self.batch_size, self.workers = batch_size, 1
+        if self.training:
+            assert n // self.world_size >= batch_size, \
+                f'{prefix}{n} images are less than a batch of {batch_size} per rank'
+            self.rank_samples = n // self.world_size // batch_size * batch_size  # whole batches
+        else:
+            self.rank_samples = int(np.isin(cache.shard, range(self.rank, len(self.shards), self.world_size)).sum())
+
+    def __len__(self):
+        return self.rank_samples  # samples per rank
+
+    def set_workers(self, workers):
+        # Number of DataLoader workers per rank, each of which needs a shard of its own in training
+        assert not self.training or len(self.shards) >= self.world_size * workers, \
+            f'{len(self.shards)} shards for {self.world_size} ranks x {workers} workers, reshard or use fewer workers'
+        self.workers = workers
+
+    def set_epoch(self, epoch):
+        # Shard order, identical on all ranks and workers
+        self.epoch = epoch
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info else (0, 1)
+        order = list(range(len(self.shards)))
+        if self.training:
+            random.Random(self.seed + self.epoch).shuffle(order)
+            nb = len(self) // self.batch_size  # batches per rank
+            n = (nb // workers + (worker < nb % workers)) * self.batch_size  # samples of this worker
+            own = order[self.rank * workers + worker::self.world_size * workers]
+            samples = islice(self.read(cycle(own + [s for s in order if s not in own])), n)
+        else:  # every sample of the rank's shards in order, worker w decoding batches w, w + workers, ...
+            samples = (x for k, x in enumerate(self.read(order[self.rank::self.world_size]))
+                       if k // self.batch_size % workers == worker)
+        self.img_buffer, self.indices = {}, []
+        for index, im in samples:
+            self.img_buffer[index] = im
+            self.indices.append(index)
+            if len(self.indices) >= self.shuffle_buffer:
+                yield self.pop()
+        while self.indices:
+            yield self.pop()
+
+    def read(self, shards):
+        # Yields the (index, encoded image) of each image in the shards, reading every shard front to back
+        for s in shards:
+            with open(self.shards[s], 'rb', buffering=1 << 22) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+                for m in tar:
+                    key, ext = os.path.splitext(m.name)
+                    if ext[1:].lower() in img_formats:
+                        yield int(key), np.frombuffer(tar.extractfile(m).read(), dtype=np.uint8)
+
+    def pop(self):
+        # Returns a random buffered sample and drops its image from the buffer
+        i = random.randrange(len(self.indices)) if self.training else 0
+        sample = self[i]
+        del self.img_buffer[self.indices[i]]
+        self.indices[i] = self.indices[-1]
+        self.indices.pop()
+        return sample
+
+    def random_index(self):
+        return random.choice(self.indices)
 
 
 # Ancillary functions --------------------------------------------------------------------------------------------------
@@ -667,14 +1460,30 @@ def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
     if img is None:  # not cached
+        lru = getattr(self, 'img_lru', None)
+        if lru is not None:
+            x = lru.get(index)
+            if x is not None:
+                return x
         path = self.img_files[index]
-        img = cv2.imread(path)  # BGR
-        assert img is not None, 'Image Not Found ' + path
-        h0, w0 = img.shape[:2]  # orig hw
+        resized = getattr(self, 'img_resized', None) and self.img_resized[index]
+        buffer = getattr(self, 'img_buffer', None)
+        if resized:  # prepared copy at img_size, see resize_dataset()
+            img = np.load(resized) if resized.endswith('.npy') else cv2.imread(resized)
+            w0, h0 = self.shapes[index].astype(int).tolist()  # orig hw
+        elif buffer is not None:  # encoded image read from a shard, see LoadShards
+            img = cv2.imdecode(buffer[index], cv2.IMREAD_COLOR)
+            w0, h0 = self.shapes[index].astype(int).tolist()  # orig hw
+        else:
+            img = cv2.imread(path)  # BGR
+            assert img is not None, 'Image Not Found ' + path
+            h0, w0 = img.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # resize image to img_size
         if r != 1:  # always resize down, only resize up if training with augmentation
-            interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
+            interp = cv2.INTER_AREA if r < 1 and not self.scaleup else cv2.INTER_LINEAR
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        if lru is not None:
+            lru.put(index, img, (h0, w0), img.shape[:2])
         return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
     else:
         return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
@@ -705,10 +1514,52 @@ def hist_equalize(img, clahe=True, bgr=False):
     return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR if bgr else cv2.COLOR_YUV2RGB)  # convert YUV image to RGB
 
 
-def load_mosaic(self, index):
-    # loads images in a 4-mosaic
-
-    labels4, segments4 = [], []
+def mosaic_canvas(self, shape):
+    # Returns this worker's mosaic canvas of shape, allocated once and reused by every later mosaic
+    canvases = getattr(self, 'mosaic_canvases', None)
+    if canvases is None:
+        canvases = self.mosaic_canvases = {}
+    if shape not in canvases:
+        canvases[shape] = np.empty(shape, dtype=np.uint8)
+    return canvases[shape]
+
+
+def fill_around(img, region, tile, value=114):
+    # Fills region xyxy of img with value except for the tile xyxy inside it
+    x1, y1, x2, y2 = region
+    x1a, y1a, x2a, y2a = tile
+    img[y1:y1a, x1:x2] = value  # above
+    img[y2a:y2, x1:x2] = value  # below
+    img[y1a:y2a, x1:x1a] = value  # left
+    img[y1a:y2a, x2a:x2] = value  # right
+
+
+def tile_labels(self, index, w, h, padw, padh):
+    # Returns the labels of image index for a (w, h) mosaic tile at (padw, padh) in pixel xyxy, and its segments as
+    # one (n,2) pixel array with the offsets of each segment in it
+    labels = self.labels[index].copy()
+    points, offsets = self.segments.flat(index)
+    if labels.size:
+        labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
+        points = xyn2xy(points, w, h, padw, padh)  # all segments at once
+    return labels, points, offsets
+
+
+def merge_segments(points, offsets):
+    # Concatenates the tile_labels() segment arrays of all tiles, returns all points and the end offset of each segment
+    ends, n = [], 0
+    for x, o in zip(points, offsets):
+        ends.append(o[1:] + n)
+        n += len(x)
+    return np.concatenate(points, 0), np.concatenate(ends)
+
+
+def mosaic4(self, index, paste=True):
+    # Builds a 4-mosaic on the reusable canvas, returns img4 (overwritten by the next mosaic), labels4, segments4 and,
+    # if not paste, the tiles [(img, x, y), ...] left to be warped by random_perspective() instead of painted on img4
+
+    labels4, points4, offsets4 = [], [], []
+    tiles = None if paste else []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
@@ -718,40 +1569,58 @@ def load_mosaic(self, index):
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            img4 = mosaic_canvas(self, (s * 2, s * 2, img.shape[2]))  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
+            quadrant = 0, 0, xc, yc
         elif i == 1:  # top right
             x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
             x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
+            quadrant = xc, 0, s * 2, yc
         elif i == 2:  # bottom left
             x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
+            quadrant = 0, yc, xc, s * 2
         elif i == 3:  # bottom right
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
+            quadrant = xc, yc, s * 2, s * 2
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        if paste:
+            img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+            fill_around(img4, quadrant, (x1a, y1a, x2a, y2a))  # background of the reused canvas
+        else:
+            tiles.append((img[y1b:y2b, x1b:x2b], x1a, y1a))
         padw = x1a - x1b
         padh = y1a - y1b
 
         # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
+        labels, points, offsets = tile_labels(self, index, w, h, padw, padh)
         labels4.append(labels)
-        segments4.extend(segments)
+        points4.append(points)
+        offsets4.append(offsets)
 
     # Concat/clip labels
     labels4 = np.concatenate(labels4, 0)
-    for x in (labels4[:, 1:], *segments4):
+    points4, ends = merge_segments(points4, offsets4)
+    for x in (labels4[:, 1:], points4):
         np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
+    segments4 = np.split(points4, ends[:-1]) if len(ends) else []  # views into points4
     # img4, labels4 = replicate(img4, labels4)  # replicate
 
+    return img4, labels4, segments4, tiles
+
+
+def load_mosaic(self, index):
+    # loads images in a 4-mosaic
+
+    paste = bool(self.hyp['copy_paste'])  # copy_paste() needs the painted mosaic, else tiles are warped directly
+    img4, labels4, segments4, tiles = mosaic4(self, index, paste=paste)
+
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
     #sample_segments(img4, labels4, segments4, probability=self.hyp['copy_paste'])
+    canvas = img4
     img4, labels4, segments4 = copy_paste(img4, labels4, segments4, probability=self.hyp['copy_paste'])
     img4, labels4 = random_perspective(img4, labels4, segments4,
                                        degrees=self.hyp['degrees'],
@@ -759,7 +1628,10 @@ def load_mosaic(self, index):
                                        scale=self.hyp['scale'],
                                        shear=self.hyp['shear'],
                                        perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+                                       border=self.mosaic_border,  # border to remove
+                                       tiles=tiles)
+    if np.may_share_memory(img4, canvas):  # not warped, detach from the reused canvas
+        img4 = img4.copy()
 
     return img4, labels4
 
@@ -767,7 +1639,8 @@ def load_mosaic(self, index):
 def load_mosaic9(self, index):
     # loads images in a 9-mosaic
 
-    labels9, segments9 = [], []
+    labels9, points9, offsets9, placed = [], [], [], []
+    paste = bool(self.hyp['copy_paste'])  # copy_paste() needs the painted mosaic, else tiles are warped directly
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
     for i, index in enumerate(indices):
@@ -776,7 +1649,9 @@ def load_mosaic9(self, index):
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+            if paste:
+                canvas = mosaic_canvas(self, (s * 3, s * 3, img.shape[2]))  # base image with 4 tiles
+                canvas.fill(114)
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -800,30 +1675,42 @@ def load_mosaic9(self, index):
         x1, y1, x2, y2 = [max(x, 0) for x in c]  # allocate coords
 
         # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
+        labels, points, offsets = tile_labels(self, index, w, h, padx, pady)
         labels9.append(labels)
-        segments9.extend(segments)
+        points9.append(points)
+        offsets9.append(offsets)
 
         # Image
-        img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        if paste:
+            canvas[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        else:
+            placed.append((img, padx, pady))
         hp, wp = h, w  # height, width previous
 
     # Offset
     yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
-    img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
+    if paste:
+        img9, tiles = canvas[yc:yc + 2 * s, xc:xc + 2 * s], None
+    else:  # tiles cropped to the 2s x 2s mosaic
+        canvas = img9 = mosaic_canvas(self, (s * 2, s * 2, img.shape[2]))
+        tiles = []
+        for img, padx, pady in placed:
+            h, w = img.shape[:2]
+            x1, y1 = max(padx, xc, 0), max(pady, yc, 0)
+            x2, y2 = min(padx + w, xc + 2 * s), min(pady + h, yc + 2 * s)
+            if x2 > x1 and y2 > y1:
+                tiles.append((img[y1 - pady:y2 - pady, x1 - padx:x2 - padx], x1 - xc, y1 - yc))
 
     # Concat/clip labels
     labels9 = np.concatenate(labels9, 0)
     labels9[:, [1, 3]] -= xc
     labels9[:, [2, 4]] -= yc
-    c = np.array([xc, yc])  # centers
-    segments9 = [x - c for x in segments9]
+    points9, ends = merge_segments(points9, offsets9)
+    points9 = points9 - np.array([xc, yc])  # centers
 
-    for x in (labels9[:, 1:], *segments9):
+    for x in (labels9[:, 1:], points9):
         np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
+    segments9 = np.split(points9, ends[:-1]) if len(ends) else []  # views into points9
     # img9, labels9 = replicate(img9, labels9)  # replicate
 
     # Augment
@@ -835,7 +1722,10 @@ def load_mosaic9(self, index):
                                        scale=self.hyp['scale'],
                                        shear=self.hyp['shear'],
                                        perspective=self.hyp['perspective'],
-                                       border=self.mosaic_border)  # border to remove
+                                       border=self.mosaic_border,  # border to remove
+                                       tiles=tiles)
+    if np.may_share_memory(img9, canvas):  # not warped, detach from the reused canvas
+        img9 = img9.copy()
 
     return img9, labels9
 
@@ -843,46 +1733,7 @@ def load_mosaic9(self, index):
 def load_samples(self, index):
     # loads images in a 4-mosaic
 
-    labels4, segments4 = [], []
-    s = self.img_size
-    yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
-    indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
-    for i, index in enumerate(indices):
-        # Load image
-        img, _, (h, w) = load_image(self, index)
-
-        # place img in img4
-        if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
-            x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
-        elif i == 1:  # top right
-            x1a, y1a, x2a, y2a = xc, max(yc - h, 0), min(xc + w, s * 2), yc
-            x1b, y1b, x2b, y2b = 0, h - (y2a - y1a), min(w, x2a - x1a), h
-        elif i == 2:  # bottom left
-            x1a, y1a, x2a, y2a = max(xc - w, 0), yc, xc, min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = w - (x2a - x1a), 0, w, min(y2a - y1a, h)
-        elif i == 3:  # bottom right
-            x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
-            x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
-
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
-        padw = x1a - x1b
-        padh = y1a - y1b
-
-        # Labels
-        labels, segments = self.labels[index].copy(), self.segments[index].copy()
-        if labels.size:
-            labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
-            segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-        labels4.append(labels)
-        segments4.extend(segments)
-
-    # Concat/clip labels
-    labels4 = np.concatenate(labels4, 0)
-    for x in (labels4[:, 1:], *segments4):
-        np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
-    # img4, labels4 = replicate(img4, labels4)  # replicate
+    img4, labels4, segments4, _ = mosaic4(self, index)
 
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
@@ -981,9 +1832,9 @@ def replicate(img, labels):
     return img, labels
 
 
-def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
-    # Resize and pad image while meeting stride-multiple constraints
-    shape = img.shape[:2]  # current shape [height, width]
+def letterbox_params(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Returns letterbox geometry for an image of shape [height, width]: ratio, unpadded (w, h), padding (dw, dh) and
+    # integer border (top, bottom, left, right)
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -1006,26 +1857,77 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     dw /= 2  # divide padding into 2 sides
     dh /= 2
 
-    if shape[::-1] != new_unpad:  # resize
-        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
+    return ratio, new_unpad, (dw, dh), (top, bottom, left, right)
+
+
+def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Resize and pad image while meeting stride-multiple constraints
+    shape = img.shape[:2]  # current shape [height, width]
+    ratio, new_unpad, (dw, dh), (top, bottom, left, right) = letterbox_params(shape, new_shape, auto, scaleFill,
+                                                                              scaleup, stride)
+    if shape[::-1] != new_unpad:  # resize
+        img = cv2.resize(img, new_unpad, interpolation=cv2.INTER_LINEAR)
     img = cv2.copyMakeBorder(img, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
     return img, ratio, (dw, dh)
 
 
-def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
-                       border=(0, 0)):
-    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
-    # targets = [cls, xyxy]
-
-    height = img.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = img.shape[1] + border[1] * 2
+def letterbox_batch(imgs, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleup=True, stride=32,
+                    device='cpu', half=False, bgr=True):
+    # Letterbox a list of uint8 HWC images (numpy or torch) on device, returning a normalized 0-1 RGB BCHW batch.
+    # Images are uploaded as uint8 and resized, padded, channel swapped and transposed into one uint8 canvas that is
+    # normalized in a single pass. Mixed image sizes share the common auto shape if all agree, else new_shape
+    imgs = imgs if isinstance(imgs, (list, tuple)) else [imgs]
+    if isinstance(new_shape, int):
+        new_shape = (new_shape, new_shape)
+    params = [letterbox_params(im.shape[:2], new_shape, auto=auto, scaleup=scaleup, stride=stride) for im in imgs]
+    shapes = {(p[1][1] + sum(p[3][:2]), p[1][0] + sum(p[3][2:])) for p in params}  # letterboxed (h, w)
+    if len(shapes) > 1:  # mixed sizes, fall back to a fixed shape
+        params = [letterbox_params(im.shape[:2], new_shape, auto=False, scaleup=scaleup, stride=stride) for im in imgs]
+        shapes = {tuple(new_shape)}
+    h, w = shapes.pop()
+
+    device = torch.device(device)
+    c = torch.tensor(color[::-1] if bgr else color, dtype=torch.uint8, device=device).view(1, 3, 1, 1)
+    canvas = c.expand(len(imgs), 3, h, w).contiguous()  # padded uint8 batch
+    for i, (im, (_, (nw, nh), _, (top, _, left, _))) in enumerate(zip(imgs, params)):
+        if device.type == 'cpu' and isinstance(im, np.ndarray):  # cv2/numpy outperform torch on CPU
+            im = cv2.resize(im, (nw, nh), interpolation=cv2.INTER_LINEAR) if im.shape[:2] != (nh, nw) else im
+            x = torch.from_numpy(np.ascontiguousarray((im[:, :, ::-1] if bgr else im).transpose(2, 0, 1)))
+        else:
+            x = torch.from_numpy(np.ascontiguousarray(im)) if isinstance(im, np.ndarray) else im
+            x = x.to(device, non_blocking=True).permute(2, 0, 1)  # HWC to CHW
+            x = x.flip(0) if bgr else x  # BGR to RGB
+            if x.shape[1:] != (nh, nw):  # resize
+                x = F.interpolate(x[None].float(), size=(nh, nw), mode='bilinear', align_corners=False)[0].round_()
+        canvas[i, :, top:top + nh, left:left + nw] = x
+    out = torch.empty(canvas.shape, dtype=torch.float16 if half else torch.float32, device=device)
+    return out.copy_(canvas).mul_(1 / 255), [p[0] for p in params], [p[2] for p in params]  # batch, ratios, pads
+
+
+def pad_batch(imgs, targets, shape, value=114 / 255):
+    # Pads a normalized BCHW batch at the bottom and right to (h, w) shape, rescaling its normalized xywh targets
+    h, w = imgs.shape[2:]
+    if (h, w) == tuple(shape):
+        return imgs, targets
+    imgs = F.pad(imgs, (0, shape[1] - w, 0, shape[0] - h), value=value)
+    targets = targets.clone()
+    targets[:, [2, 4]] *= w / shape[1]
+    targets[:, [3, 5]] *= h / shape[0]
+    return imgs, targets
+
+
+def random_perspective_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0, border=(0, 0)):
+    # Returns the random 3x3 transform M of random_perspective() for an image of shape (h, w), its scale and output h, w
+
+    height = shape[0] + border[0] * 2
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -img.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -img.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -1052,7 +1954,23 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+    return M, s, height, width
+
+
+def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
+                       border=(0, 0), tiles=None):
+    # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
+    # targets = [cls, xyxy]
+    # tiles = [(tile, x, y), ...] of an unpainted mosaic img, painted only where an affine transform samples it, else
+    # painted on the whole of img first
+
+    M, s, height, width = random_perspective_matrix(img.shape[:2], degrees, translate, scale, shear, perspective, border)
+    if tiles is not None and (M[2, 0] or M[2, 1]):
+        paint_tiles(img, tiles)  # perspective
+        tiles = None
+    if tiles is not None:
+        img = warp_tiles(img, tiles, M, width, height)
+    elif (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
         if perspective:
             img = cv2.warpPerspective(img, M, dsize=(width, height), borderValue=(114, 114, 114))
         else:  # affine
@@ -1070,15 +1988,7 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
         use_segments = any(x.any() for x in segments)
         new = np.zeros((n, 4))
         if use_segments:  # warp segments
-            segments = resample_segments(segments)  # upsample
-            for i, segment in enumerate(segments):
-                xy = np.ones((len(segment), 3))
-                xy[:, :2] = segment
-                xy = xy @ M.T  # transform
-                xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]  # perspective rescale or affine
-
-                # clip
-                new[i] = segment2box(xy, width, height)
+            new[:len(segments)] = segment_boxes(segments, M, width, height, perspective)
 
         else:  # warp boxes
             xy = np.ones((n * 4, 3))
@@ -1103,14 +2013,218 @@ def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, s
     return img, targets
 
 
+def paint_tiles(img, tiles):
+    # Paints mosaic tiles [(tile, x, y), ...] on img over a 114 background
+    img.fill(114)
+    for tile, x, y in tiles:
+        h, w = tile.shape[:2]
+        img[y:y + h, x:x + w] = tile
+
+
+def warp_tiles(img, tiles, M, width, height):
+    # Warps the mosaic img of tiles [(tile, x, y), ...] by the affine M into a (height, width) image, painting the tiles
+    # only on the crop of img that the output samples. Pixels outside the crop are never read and those outside img are
+    # the 114 border, so the result equals warpAffine() of the whole painted mosaic, tile/tile seams included
+    h, w = img.shape[:2]
+    corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]], dtype=np.float64).T
+    xy = np.linalg.inv(M)[:2] @ corners  # output corners on the mosaic
+    x1, y1 = [min(max(math.floor(v) - 2, 0), n) for v, n in zip(xy.min(1), (w, h))]  # 2 px bilinear/rounding margin
+    x2, y2 = [min(max(math.ceil(v) + 2, 0), n) for v, n in zip(xy.max(1), (w, h))]
+    if x2 <= x1 or y2 <= y1:  # nothing of the mosaic in view
+        return np.full((height, width, img.shape[2]), 114, dtype=np.uint8)
+    crop = img[y1:y2, x1:x2]
+    crop.fill(114)
+    for tile, x, y in tiles:
+        th, tw = tile.shape[:2]
+        u1, v1, u2, v2 = max(x, x1), max(y, y1), min(x + tw, x2), min(y + th, y2)  # tile part inside the crop
+        if u2 > u1 and v2 > v1:
+            crop[v1 - y1:v2 - y1, u1 - x1:u2 - x1] = tile[v1 - y:v2 - y, u1 - x:u2 - x]
+    A = cv2.invertAffineTransform(M[:2])  # output to mosaic, as warpAffine() inverts M
+    A[:, 2] -= (x1, y1)  # output to crop, an integer shift that keeps warpAffine() fixed-point rounding
+    return cv2.warpAffine(crop, A, dsize=(width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderValue=(114, 114, 114))
+
+
+def segment_boxes(segments, M, width, height, perspective=False):
+    # Returns the boxes of segments warped by M and clipped to the image, as xyxy (n,4). Segments inside the image are
+    # boxed by their vertices and segments outside it are empty, only those crossing the border are resampled at about
+    # two points per output pixel (up to 1000 points) and boxed by the points inside the image
+    n = np.array([len(x) for x in segments])
+    i = np.cumsum(n) - n  # first point of each segment
+    xy = np.ones((n.sum(), 3))
+    xy[:, :2] = np.concatenate(segments, 0)
+    xy = xy @ M.T  # transform
+    xy = xy[:, :2] / xy[:, 2:3] if perspective else xy[:, :2]  # perspective rescale or affine
+    x, y = xy.T
+    inside = (x >= 0) & (y >= 0) & (x <= width) & (y <= height)
+    new = np.stack((np.minimum.reduceat(x, i), np.minimum.reduceat(y, i),
+                    np.maximum.reduceat(x, i), np.maximum.reduceat(y, i)), 1)
+    outside = (new[:, 2] < 0) | (new[:, 3] < 0) | (new[:, 0] > width) | (new[:, 1] > height)
+    new[outside] = 0
+    for j in np.flatnonzero(~np.logical_and.reduceat(inside, i) & ~outside):  # crossing the image border
+        p = xy[i[j]:i[j] + n[j]]
+        length = np.linalg.norm(p - np.roll(p, 1, 0), axis=1).sum()  # closed outline in output pixels
+        segment = resample_segments([segments[j]], n=int(min(max(2 * length, n[j] + 1), 1000)))[0]  # upsample
+        q = np.ones((len(segment), 3))
+        q[:, :2] = segment
+        q = q @ M.T  # transform
+        new[j] = segment2box(q[:, :2] / q[:, 2:3] if perspective else q[:, :2], width, height)
+    return new
+
+
 def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
     # Compute candidate boxes: box1 before augment, box2 after augment, wh_thr (pixels), aspect_ratio_thr, area_ratio
     w1, h1 = box1[2] - box1[0], box1[3] - box1[1]
     w2, h2 = box2[2] - box2[0], box2[3] - box2[1]
-    ar = np.maximum(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
+    ar = torch.maximum(w2 / (h2 + eps), h2 / (w2 + eps)) if isinstance(w2, torch.Tensor) else \
+        np.maximum(w2 / (h2 + eps), h2 / (w2 + eps))  # aspect ratio
     return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
 
 
+class BatchAugment:
+    """
+    On-device augmentation of letterboxed training batches, for DataLoaders built with augment=False when CPU workers
+    can not keep up. Applies mosaic (partners drawn from the batch), random perspective, mixup, HSV jitter and flips
+    with the same hyp keys as LoadImagesAndLabels, warping with grid_sample. copy_paste and paste_in need segments
+    and stay CPU only. imgs are (b,3,s,s) RGB 0-1, targets (n,6) image, class, normalized xywh, and shapes the letterbox
+    shapes of collate_fn, from which mosaic tiles are cropped to their image content as in load_mosaic().
+    """
+
+    def __init__(self, hyp, img_size):
+        self.hyp = hyp
+        self.img_size = img_size
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+
+    def __call__(self, imgs, targets, shapes):
+        hyp, s = self.hyp, self.img_size
+        b, device = imgs.shape[0], imgs.device
+        assert imgs.shape[2:] == (s, s), f'BatchAugment expects {s}x{s} letterboxed images, got {tuple(imgs.shape[2:])}'
+
+        # Image content of each letterboxed tile, x1y1x2y2 as letterbox() pads it
+        content = torch.tensor([[round(dw - 0.1), round(dh - 0.1), round(dw - 0.1) + round(s - 2 * dw),
+                                 round(dh - 0.1) + round(s - 2 * dh)] for _, (_, (dw, dh)) in shapes], dtype=torch.float)
+
+        # Mosaic tiles: 4 images placed around a random center on a 2s canvas as in load_mosaic(), or the image alone
+        # at the canvas center, letterbox padding included as in the non-mosaic path
+        mosaic = torch.tensor([random.random() < hyp['mosaic'] for _ in range(b)])
+        index = torch.arange(b).repeat(4, 1)  # (4,b) batch image of each tile
+        origin = torch.full((4, b, 2), s / 2)  # (4,b,2) tile top left on the canvas
+        rect = torch.tensor([0, 0, s, s], dtype=torch.float).repeat(4, b, 1)  # (4,b,4) tile area to place, x1y1x2y2
+        for i in torch.nonzero(mosaic)[:, 0].tolist():
+            yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
+            index[1:, i] = torch.tensor(random.choices(range(b), k=3))  # 3 additional image indices
+            rect[:, i] = content[index[:, i]]
+            w, h = (rect[:, i, 2:] - rect[:, i, :2]).T
+            xy = torch.stack((torch.tensor([xc, xc, xc, xc]) - w * torch.tensor([1, 0, 1, 0]),
+                              torch.tensor([yc, yc, yc, yc]) - h * torch.tensor([1, 1, 0, 0])), 1)  # top left, placed
+            origin[:, i] = xy - rect[:, i, :2]
+        active = torch.cat((torch.ones(1, b, dtype=torch.bool), mosaic.repeat(3, 1)))  # (4,b)
+
+        # Random perspective of each canvas into s x s, as random_perspective(border=self.mosaic_border)
+        M, scale = zip(*[random_perspective_matrix((2 * s, 2 * s), hyp['degrees'], hyp['translate'], hyp['scale'],
+                                                   hyp['shear'], hyp['perspective'], self.mosaic_border)[:2]
+                         for _ in range(b)])
+        M, scale = torch.tensor(np.stack(M), dtype=torch.float, device=device), torch.tensor(scale, device=device)
+        imgs = self.warp(imgs, M, index.to(device), origin.to(device), rect.to(device), active.to(device))
+        targets = self.warp_targets(targets, M, scale, index, origin, active)
+
+        # MixUp https://arxiv.org/pdf/1710.09412.pdf, with another mosaic of the batch
+        mosaics = torch.nonzero(mosaic)[:, 0].tolist()
+        mixed = [i for i in mosaics if random.random() < hyp['mixup']]
+        if mixed:
+            other = [random.choice(mosaics) for _ in mixed]
+            r = torch.tensor(np.random.beta(8.0, 8.0, len(mixed)), dtype=imgs.dtype, device=device).view(-1, 1, 1, 1)
+            imgs[mixed] = imgs[mixed] * r + imgs[other] * (1 - r)  # partners as before mixing
+            t = [targets]
+            for i, j in zip(mixed, other):
+                t.append(targets[targets[:, 0] == j].clone())  # labels of the partner before mixing
+                t[-1][:, 0] = i
+            targets = torch.cat(t, 0)
+
+        # Augment colorspace
+        gains = torch.tensor(np.random.uniform(-1, 1, (b, 3)) * [hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']] + 1,
+                             dtype=imgs.dtype, device=device)
+        imgs = self.hsv(imgs, gains)
+
+        # Normalized xywh
+        if len(targets):
+            targets[:, 2:6] = xyxy2xywh(targets[:, 2:6]) / s
+
+        # Flip up-down and left-right
+        for flip, dim, col in (('flipud', 2, 3), ('fliplr', 3, 2)):
+            f = torch.tensor([random.random() < hyp[flip] for _ in range(b)], device=device)
+            imgs = torch.where(f.view(-1, 1, 1, 1), imgs.flip(dim), imgs)
+            if len(targets):
+                i = f[targets[:, 0].long()]
+                targets[i, col] = 1 - targets[i, col]
+
+        return imgs.contiguous(), targets
+
+    def warp(self, imgs, M, index, origin, rect, active):
+        # Samples each output pixel from the tile area under it on the canvas, elsewhere the 114 background
+        b, _, s, _ = imgs.shape
+        r = torch.arange(s, device=imgs.device, dtype=imgs.dtype)
+        x, y = r.view(1, -1).expand(s, s), r.view(-1, 1).expand(s, s)  # pixel grid, meshgrid(indexing='ij')
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).view(1, -1, 3) @ torch.inverse(M).transpose(1, 2)
+        xy = (xy[..., :2] / xy[..., 2:]).view(b, s, s, 2)  # canvas coordinates of output pixels (perspective divide)
+        inside = ((xy >= -0.5) & (xy < 2 * s - 0.5)).all(-1).unsqueeze(1)  # canvas bounds
+        src = torch.cat((imgs, torch.ones_like(imgs[:, :1])), 1)  # with a coverage channel
+        out = torch.zeros_like(src)
+        for k in range(4):
+            i = torch.nonzero(active[k])[:, 0]  # images with a k-th tile
+            if len(i):
+                t = xy[i] - origin[k, i].view(-1, 1, 1, 2)  # tile pixel coordinates
+                a = rect[k, i].view(-1, 1, 1, 4) - 0.5
+                m = ((t >= a[..., :2]) & (t < a[..., 2:])).all(-1).unsqueeze(1)  # tile area footprint
+                tile = F.grid_sample(src[index[k, i]], (t + 0.5) / s * 2 - 1, mode='bilinear', padding_mode='zeros',
+                                     align_corners=False)
+                out[i] += tile * (inside[i] & m)
+        return out[:, :3] + (1 - out[:, 3:]) * (114 / 255)
+
+    def warp_targets(self, targets, M, scale, index, origin, active):
+        # Places the boxes of each tile on the canvas and warps them as random_perspective() warps boxes
+        s = self.img_size
+        labels = []
+        for k in range(4):
+            i, j = torch.nonzero((targets[:, 0].cpu()[None] == index[k][:, None]) & active[k][:, None], as_tuple=True)
+            t = targets[j].clone()
+            t[:, 0] = i.to(t.device)
+            t[:, 2:6] = xywhn2xyxy(t[:, 2:6], s, s, 0, 0) + origin[k][i].repeat(1, 2).to(t.device)
+            labels.append(t)
+        targets = torch.cat(labels, 0)
+        n = len(targets)
+        if not n:
+            return targets
+        targets[:, 2:6] = targets[:, 2:6].clamp(0, 2 * s)  # clip to the canvas
+        m = M[targets[:, 0].long()]
+        xy = torch.ones((n, 4, 3), device=targets.device)
+        xy[..., :2] = targets[:, [2, 3, 4, 5, 2, 5, 4, 3]].view(n, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+        xy = xy @ m.transpose(1, 2)  # transform
+        xy = xy[..., :2] / xy[..., 2:]  # perspective rescale or affine
+        new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, s)  # xyxy clipped to the output
+
+        # filter candidates
+        i = box_candidates(box1=targets[:, 2:6].T * scale[targets[:, 0].long()], box2=new.T, area_thr=0.10)
+        targets = targets[i]
+        targets[:, 2:6] = new[i]
+        return targets
+
+    @staticmethod
+    def hsv(imgs, gains):
+        # augment_hsv() for RGB 0-1 batches, gains (b,3) scale hue, saturation and value
+        r, g, b = imgs.unbind(1)
+        v, _ = imgs.max(1)
+        c = v - imgs.min(1)[0]
+        s = c / v.clamp(min=1e-8)
+        h = torch.where(v == r, (g - b) / c.clamp(min=1e-8), torch.where(v == g, 2 + (b - r) / c.clamp(min=1e-8),
+                                                                          4 + (r - g) / c.clamp(min=1e-8)))
+        h = (h * 60 % 360) * gains[:, 0].view(-1, 1, 1) % 360  # degrees
+        s = (s * gains[:, 1].view(-1, 1, 1)).clamp(0, 1)
+        v = (v * gains[:, 2].view(-1, 1, 1)).clamp(0, 1)
+        k = (torch.tensor([5, 3, 1], device=imgs.device, dtype=imgs.dtype).view(1, 3, 1, 1) + h[:, None] / 60) % 6
+        return v[:, None] - (v * s)[:, None] * torch.clamp(torch.minimum(k, 4 - k), 0, 1)
+
+
 def bbox_ioa(box1, box2):
     # Returns the intersection over box2 area given box1, box2. box1 is 4, box2 is nx4. boxes are x1y1x2y2
     box2 = box2.transpose()
@@ -1200,7 +2314,7 @@ def pastein(image, labels, sample_labels, sample_images, sample_masks):
                 r_image = cv2.resize(sample_images[sel_ind], (r_w, r_h))
                 temp_crop = image[ymin:ymin+r_h, xmin:xmin+r_w]
                 m_ind = r_mask > 0
-                if m_ind.astype(np.int32).sum() > 60:
+                if m_ind.astype(np.int32).sum() > (20 if m_ind.ndim == 2 else 60):  # crop bank pixels or elements
                     temp_crop[m_ind] = r_image[m_ind]
                     #print(sample_labels[sel_ind])
                     #print(sample_images[sel_ind].shape)
@@ -1313,6 +2427,208 @@ def autosplit(path='../coco', weights=(0.9, 0.1, 0.0), annotated_only=False):
                 f.write(str(img) + '\n')  # add image to txt file
     
     
+def resized_dir(path, img_size):
+    # Directory of the resize_dataset() copies of the images in directory path
+    return Path(f'{Path(path).as_posix()}_{img_size}')
+
+
+def resized_files(files, img_size, mtimes):
+    # Returns the newer-than-original resize_dataset() copy of each image file, or None to use the original
+    copies = {}  # directory -> {stem: (copy, mtime)}
+    resized = []
+    for f, mtime in zip(files, mtimes):
+        parent = os.path.dirname(f)
+        if parent not in copies:
+            d, copies[parent] = resized_dir(parent, img_size), {}
+            if d.is_dir():
+                for x in os.scandir(d):
+                    copies[parent][Path(x.name).stem] = x.path, x.stat().st_mtime_ns
+        copy, copy_mtime = copies[parent].get(Path(f).stem, (None, 0))
+        resized.append(copy if copy_mtime >= mtime else None)
+    return resized
+
+
+def resize_dataset(path='../coco/images/train2017', img_size=640, fmt='jpg', quality=95):
+    """ Write copies of dataset images resized to img_size to path_<img_size>/ for cheaper decoding.
+    LoadImagesAndLabels at the same img_size prefers up-to-date copies and falls back to the originals.
+    Usage: from utils.datasets import *; resize_dataset('../coco/images/train2017', 640)
+    Arguments
+        path:     Images directory, or *.txt file listing images
+        img_size: Training image size (long side)
+        fmt:      'jpg' (reduced JPEG at quality), 'png' (lossless) or 'npy' (raw uint8, fastest to decode, largest)
+        quality:  JPEG quality
+    """
+    assert fmt in ('jpg', 'png', 'npy'), f'invalid format {fmt}'
+    path = Path(path)
+    if path.is_file():
+        with open(path, 'r') as t:
+            parent = str(path.parent) + os.sep
+            files = [x.replace('./', parent) if x.startswith('./') else x for x in t.read().strip().splitlines()]
+    else:
+        files = [str(x) for x in path.rglob('*.*')]
+    files = [x for x in files if x.split('.')[-1].lower() in img_formats]
+    stems = Counter(os.path.splitext(x)[0] for x in files)
+    files = [x for x in files if stems[os.path.splitext(x)[0]] == 1]  # copies are named by stem, skip ambiguous ones
+
+    def resize(f):
+        # Returns the bytes written, 0 for images already at or below img_size
+        img = cv2.imread(f)  # BGR
+        h0, w0 = img.shape[:2]
+        r = img_size / max(h0, w0)
+        if r >= 1:
+            return 0
+        img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_AREA)
+        d = resized_dir(Path(f).parent, img_size)
+        d.mkdir(parents=True, exist_ok=True)
+        out = d / f'{Path(f).stem}.{fmt}'
+        if fmt == 'npy':
+            np.save(out, img)
+        else:
+            cv2.imwrite(str(out), img, [cv2.IMWRITE_JPEG_QUALITY, quality] if fmt == 'jpg' else [])
+        return out.stat().st_size
+
+    gb = 0
+    pbar = tqdm(ThreadPool(num_threads).imap(resize, files), total=len(files))
+    for x in pbar:
+        gb += x / 1E9
+        pbar.desc = f'Resizing images to {img_size} ({gb:.1f}GB)'
+    pbar.close()
+
+
+def is_shards(path):
+    # Whether path is a directory of shards written by shard_dataset()
+    return isinstance(path, (str, Path)) and (Path(path) / 'index.cache').is_file()
+
+
+def shard_dataset(path='../coco/train2017.txt', out=None, shard_size=1E9, img_size=None, quality=95, seed=0):
+    """ Pack a dataset into tar shards of encoded images and label files plus an index, for sequential reading.
+    The samples are shuffled once across shards, and the index is a LabelStore of their labels and original shapes with
+    the shard of each sample. Training on the output directory uses LoadShards.
+    Usage: from utils.datasets import *; shard_dataset('../coco/train2017.txt', '../coco/train2017_shards')
+    Arguments
+        path:       Images directory or *.txt file, as for LoadImagesAndLabels
+        out:        Output directory, default path_shards
+        shard_size: Approximate shard size in bytes
+        img_size:   Re-encode images resized to img_size as JPEG at quality, default keeps the original bytes
+        seed:       Sample shuffle seed
+    """
+    out = Path(out or Path(path).with_suffix('').as_posix() + '_shards')
+    out.mkdir(parents=True, exist_ok=True)
+    dataset = LoadImagesAndLabels(path, augment=False)  # verified labels and shapes
+    order = list(range(dataset.n))
+    random.Random(seed).shuffle(order)
+
+    def encode(i):
+        # Returns the encoded image i, re-encoded if resized or if its decoded shape differs from the label cache
+        f, (w0, h0) = dataset.img_files[i], dataset.shapes[i].astype(int)
+        with open(f, 'rb') as fb:
+            im = fb.read()
+        if img_size or cv2.imdecode(np.frombuffer(im, np.uint8), cv2.IMREAD_COLOR).shape[:2] != (h0, w0):  # EXIF
+            img = cv2.imread(f)  # BGR, EXIF orientation applied as in load_image
+            r = img_size / max(h0, w0) if img_size else 1
+            if r < 1:
+                img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=cv2.INTER_AREA)
+            return '.jpg', cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        return Path(f).suffix.lower(), im
+
+    def add(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size, info.mtime = len(data), time.time()
+        tar.addfile(info, BytesIO(data))
+
+    shards, shard, tar, size = [], np.zeros(dataset.n, dtype=np.int32), None, 0
+    pbar = tqdm(zip(order, ThreadPool(num_threads).imap(encode, order)), total=dataset.n)
+    for k, (i, (ext, im)) in enumerate(pbar):
+        if tar is None or size > shard_size:  # next shard
+            if tar:
+                tar.close()
+            shards.append(f'{len(shards):06d}.tar')
+            tar, size = tarfile.open(out / shards[-1], 'w'), 0
+        l = dataset.labels[i]
+        add(tar, f'{k:09d}{ext}', im)
+        add(tar, f'{k:09d}.txt', ''.join(('%g ' * len(x)).rstrip() % tuple(x) + '\n' for x in l).encode())
+        shard[k], size = len(shards) - 1, size + len(im)
+        pbar.desc = f'Packing {len(shards)} shards'
+    if tar:
+        tar.close()
+    pbar.close()
+
+    entries = [(np.array(dataset.labels[i]), tuple(dataset.shapes[i].astype(int)), dataset.segments[i]) for i in order]
+    counts = np.array([[0, 1, 0, 0] if len(e[0]) else [0, 0, 1, 0] for e in entries], dtype=np.uint8)
+    nm, nf, ne, nc = counts.sum(0).tolist()
+    index = LabelStore.from_entries([dataset.img_files[i] for i in order], np.zeros((dataset.n, 4)), counts, entries,
+                                    hash=0, results=(nf, nm, ne, nc, dataset.n), shards=shards)
+    index.arrays['shard'] = shard
+    index.save(out / 'index.cache')
+    print(f'Packed {dataset.n} images into {len(shards)} shards in {out}')
+
+
+def crop_bank(path='../coco/train2017.txt', img_size=640, max_size=320):
+    """ Extract every labelled segment of a dataset once into a CropBank, saved next to the label cache as *.crops.
+    Training with paste_in > 0 at the same img_size then draws paste-in objects from the bank instead of mosaicking
+    extra images, and with hyp['paste_in_balanced'] draws their classes uniformly. Rebuild after labels change.
+    Usage: from utils.datasets import *; crop_bank('../coco/train2017.txt')
+    Arguments
+        path:     Images directory or *.txt file, as for LoadImagesAndLabels
+        img_size: Training image size, crops are cut from images loaded at this size
+        max_size: Crops with a longer side are downscaled to it, bounding the bank size
+    """
+    dataset = LoadImagesAndLabels(path, img_size, augment=False)  # verified labels and segments
+    dataset.scaleup = True  # load_image() interpolation as in training
+    cache = dataset.labels.store
+    out = (Path(path) if Path(path).is_file() else Path(dataset.label_files[0]).parent).with_suffix('.crops')
+    tmp = out.with_suffix('.pixels.tmp'), out.with_suffix('.masks.tmp')
+
+    classes, shapes, sizes = [], [], [0]
+    with open(tmp[0], 'wb') as fp, open(tmp[1], 'wb') as fm:
+        pbar = tqdm(range(dataset.n), desc='Extracting crops')
+        for i in pbar:
+            segments = dataset.segments[i]
+            if not segments:
+                continue
+            img, _, (h, w) = load_image(dataset, i)
+            labels = dataset.labels[i]
+            boxes = xywhn2xyxy(labels[:, 1:], w, h).astype(int)
+            for c, (x1, y1, x2, y2), s in zip(labels[:, 0], boxes, segments):  # as sample_segments()
+                x1, x2 = np.clip((x1, x2), 0, w - 1).tolist()
+                y1, y2 = np.clip((y1, y2), 0, h - 1).tolist()
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                mask = np.zeros((y2 - y1, x2 - x1), np.uint8)
+                cv2.drawContours(mask, [xyn2xy(s, w, h).astype(np.int32)], -1, 255, cv2.FILLED, offset=(-x1, -y1))
+                im = cv2.bitwise_and(img[y1:y2, x1:x2], img[y1:y2, x1:x2], mask=mask)
+                r = max_size / max(mask.shape)
+                if r < 1:
+                    wh = max(1, int((x2 - x1) * r)), max(1, int((y2 - y1) * r))
+                    im = cv2.resize(im, wh, interpolation=cv2.INTER_AREA)
+                    mask = cv2.resize(mask, wh, interpolation=cv2.INTER_NEAREST)
+                fp.write(im.data)
+                fm.write(mask.data)
+                classes.append(c)
+                shapes.append(mask.shape)
+                sizes.append(mask.size)
+            pbar.desc = f'Extracting crops ({len(classes)} found, {sum(sizes) * 4 / 1E9:.2f}GB)'
+        pbar.close()
+
+    classes = np.array(classes, dtype=np.int32)
+    offsets = np.cumsum(sizes, dtype=np.int64)
+    class_index = np.argsort(classes, kind='stable')  # crops grouped by class
+    n = offsets[-1]
+    arrays = {'classes': classes,
+              'shapes': np.array(shapes, dtype=np.int64).reshape(-1, 2),
+              'offsets': offsets,
+              'class_index': class_index,
+              'class_offsets': np.searchsorted(classes[class_index], np.arange(classes.max(initial=-1) + 2)),
+              'pixels': np.memmap(tmp[0], np.uint8, 'r', shape=(n, 3)) if n else np.zeros((0, 3), np.uint8),
+              'masks': np.memmap(tmp[1], np.uint8, 'r', shape=(n,)) if n else np.zeros(0, np.uint8)}
+    CropBank(arrays, {'version': CropBank.version, 'hash': cache.meta.get('hash'), 'img_size': img_size,
+                      'max_size': max_size}).save(out)
+    del arrays  # unmap the temporary files
+    for f in tmp:
+        f.unlink()
+    print(f'Extracted {len(classes)} crops of {dataset.n} images into {out}')
+
+
 def load_segmentations(self, index):
     key = '/work/handsomejw66/coco17/' + self.img_files[index]
     #print(key)
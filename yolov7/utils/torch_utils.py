@@ -93,6 +93,26 @@ def time_synchronized():
     return time.time()
 
 
+def cpu_memory(reset=False):
+    # Returns the current and peak resident memory of this process in GB (Linux), the peak since the last reset=True
+    # call, for CPU memory measurements where torch.cuda.max_memory_allocated() is not available
+    if reset:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')  # reset the VmHWM peak to the current resident size
+    with open('/proc/self/status') as f:
+        status = dict(x.split(':', 1) for x in f)
+    return tuple(int(status[k].split()[0]) / 1E6 for k in ('VmRSS', 'VmHWM'))  # kB
+
+
+def script(fn):
+    # torch.jit.script() fn so that its elementwise ops fuse into few kernels, fn itself where it cannot be scripted
+    try:
+        return torch.jit.script(fn)
+    except Exception as e:
+        logger.warning(f'TorchScript unavailable for {fn.__name__}, running it eagerly: {e}')
+        return fn
+
+
 def profile(x, ops, n=100, device=None):
     # profile a pytorch module or list of modules. Example usage:
     #     x = torch.randn(16, 3, 640, 640)  # input
@@ -266,6 +286,41 @@ def copy_attr(a, b, include=(), exclude=()):
             setattr(a, k, v)
 
 
+def compile_model(model, shapes, batch_size, last=0, ch=3, amp=False):
+    # torch.compile() a training model with one static graph per (h, w) in shapes and batch size, batch_size and the
+    # last partial batch size if not 0. Each graph is compiled up front with a forward and backward pass, so training
+    # does not stall on recompilation; BatchNorm statistics and gradients of the warmup batches are discarded. Returns
+    # model itself on torch<2.0
+    if not hasattr(torch, 'compile'):
+        logger.warning(f'torch.compile() requires torch>=2.0, training eagerly with torch {torch.__version__}')
+        return model
+    from torch._dynamo import config as dynamo_config
+    from torch._inductor import config as inductor_config
+    shapes = sorted({tuple(int(x) for x in s) for s in shapes})
+    limit = 2 * len(shapes) + 2  # full and last batch of every shape
+    dynamo_config.cache_size_limit = max(dynamo_config.cache_size_limit, limit)
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True  # reuse kernels compiled by earlier runs
+    compiled = torch.compile(model, dynamic=False)
+
+    t = time.time()
+    device = next(model.parameters()).device
+    buffers = [b.clone() for b in model.buffers()]
+    sizes = [batch_size] + ([last] if 0 < last != batch_size else [])
+    for h, w in shapes:
+        for n in sizes:
+            with torch.cuda.amp.autocast(enabled=amp):
+                y = compiled(torch.zeros(n, ch, h, w, device=device))
+            sum(yi.float().sum() for yi in y).backward()
+    with torch.no_grad():
+        for b, b0 in zip(model.buffers(), buffers):
+            b.copy_(b0)
+    for p in model.parameters():
+        p.grad = None
+    logger.info(f'Compiled {len(shapes)} training shape(s) {shapes} at batch size {sizes} in {time.time() - t:.1f}s')
+    return compiled
+
+
 class ModelEMA:
     """ Model Exponential Moving Average from https://github.com/rwightman/pytorch-image-models
     Keep a moving average of everything in the model state_dict (parameters and buffers).